@@ -0,0 +1,86 @@
+"""Compare reading a file storage with file iterators and memory-mapping.
+
+All of the records are read, with and without finding the references
+in each record, using ZODB's file iterator, as for --file-storage/-f,
+and the memory-mapping iterator, as for --mmap/-F.  Give the path of a
+file storage to read, preferably a large one, or a number of objects
+to write to a temporary file storage first.  Run it more than once on
+large files so both readers see the file in the page cache.
+
+Usage: python benchmarks/iterators.py [path-or-objects]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import BTrees.LOBTree
+import persistent.mapping
+import transaction
+import ZODB
+import ZODB.FileStorage
+
+import zc.zodbdgc
+
+
+def make(path, nobjects, per_transaction=100):
+    db = ZODB.DB(path)
+    conn = db.open()
+    obs = conn.root()['obs'] = BTrees.LOBTree.BTree()
+    for i in range(nobjects):
+        ob = obs[i] = persistent.mapping.PersistentMapping(data='x' * 200)
+        if i:
+            ob['parent'] = obs[i // 2]
+        if i % per_transaction == 0:
+            transaction.commit()
+    transaction.commit()
+    db.close()
+
+
+def read(it, refs):
+    nrecords = nbytes = 0
+    try:
+        for trans in it:
+            for record in trans:
+                data = record.data
+                nrecords += 1
+                if data:
+                    nbytes += len(data)
+                    if refs:
+                        for ref in zc.zodbdgc.getrefs(data, '', ()):
+                            pass
+    finally:
+        it.close()
+    return nrecords, nbytes
+
+
+def main(path):
+    print('%-22s %10s %10s %8s' % ('', 'records/s', 'MB/s', 'seconds'))
+    results = set()
+    for refs in (False, True):
+        for label, factory in (
+                ('file iterator', ZODB.FileStorage.FileIterator),
+                ('mmap', zc.zodbdgc.MappedIterator),
+        ):
+            start = time.perf_counter()
+            result = read(factory(path), refs)
+            elapsed = time.perf_counter() - start
+            results.add(result)
+            nrecords, nbytes = result
+            if refs:
+                label += ', refs'
+            print('%-22s %10.0f %10.1f %8.2f' % (
+                label, nrecords / elapsed, nbytes / elapsed / 1e6, elapsed))
+
+    assert len(results) == 1, "results differ"
+
+
+if __name__ == '__main__':
+    arg = sys.argv[1] if len(sys.argv) > 1 else '100000'
+    if os.path.exists(arg):
+        main(arg)
+    else:
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'Data.fs')
+            make(path, int(arg))
+            main(path)
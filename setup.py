@@ -25,6 +25,8 @@ entry_points = """
 [console_scripts]
 multi-zodb-gc = zc.zodbdgc:gc_command
 multi-zodb-check-refs = zc.zodbdgc:check_command
+multi-zodb-gc-worker = zc.zodbdgc:worker_command
+multi-zodb-gc-merge = zc.zodbdgc:merge_command
 """
 
 
@@ -13,12 +13,22 @@
 ##############################################################################
 
 
+import bisect
+import collections
+import concurrent.futures
+import itertools
 import logging
 import marshal
+import math
+import mmap
 import optparse
+import os
+import queue
+import random
 import struct
 import sys
 import tempfile
+import threading
 import time
 from io import BytesIO
 
@@ -26,12 +36,17 @@ import BTrees.fsBTree
 import BTrees.LLBTree
 import BTrees.OOBTree
 import transaction
+import ZConfig
+import ZODB.BaseStorage
 import ZODB.blob
 import ZODB.config
 import ZODB.FileStorage
+import ZODB.FileStorage.format
+import ZODB.FileStorage.fspack
 import ZODB.fsIndex
 import ZODB.POSException
 import ZODB.serialize
+import ZODB.utils
 from persistent import TimeStamp
 from ZODB.Connection import TransactionMetaData
 from ZODB.utils import z64
@@ -72,9 +87,66 @@ def gc_command(args=None, ptid=None, return_bad=False):
         level = None
 
     parser = optparse.OptionParser("usage: %prog [options] config1 [config2]")
+    _add_analysis_options(parser)
+    _add_removal_options(parser)
+    parser.add_option(
+        '-s', '--summaries', dest='summaries',
+        help='Directory to save summaries of the references from each'
+        ' database to other databases in.')
+    parser.add_option(
+        '-o', '--only', dest='only',
+        help='Collect garbage in the named database only, using the'
+        ' summaries in the --summaries directory, updated with the'
+        ' transactions committed since they were saved, for the'
+        ' references from other databases.')
+
+    options, args = parser.parse_args(args)
+
+    if not args or len(args) > 2:
+        parser.parse_args(['-h'])
+    elif options.only is not None and not options.summaries:
+        parser.error("--only requires --summaries")
+    elif len(args) == 2:
+        conf2 = args[1]
+    else:
+        conf2 = None
+
+    _setup_logging(options, level)
+
+    return gc(args[0], options.days, options.ignore or (), conf2=conf2,
+              fs=dict(o.split('=') for o in options.fs or ()),
+              untransform=_untransform(options),
+              ptid=ptid, return_bad=return_bad,
+              read_ahead=options.read_ahead, current=options.current,
+              pack=options.pack, bulk=options.bulk,
+              throttle=_throttle(options), summaries=options.summaries,
+              only=options.only, mapped=options.mapped,
+              bulk_delete=options.bulk_delete)
+
+
+def _add_analysis_options(parser):
+    parser.add_option(
+        '-a', '--read-ahead', dest='read_ahead', type='int', default=0,
+        help='Number of transactions to read ahead in a background thread'
+        ' when iterating over storages (rather than files given with'
+        ' -f). The default, 0, disables reading ahead.')
+    parser.add_option(
+        '-b', '--bulk', dest='bulk', action='store_true',
+        help='Read RelStorage databases with bulk queries, rather than'
+        ' a query per transaction, and remove garbage from history-free'
+        ' RelStorage databases with batched deletes.')
+    parser.add_option(
+        '-c', '--current-only', dest='current', action='store_true',
+        help='For databases given with -f, read only the current revisions'
+        ' of old records, using the file-storage index file, rather than'
+        ' all revisions.')
     parser.add_option(
         '-d', '--days', dest='days', type='int', default=1,
         help='Number of trailing days (defaults to 1) to treat as non-garbage')
+    parser.add_option(
+        '-F', '--mmap', dest='mapped', action='store_true',
+        help='Read the files given with -f by memory-mapping them, rather'
+        ' than with file-storage iterators.')
     parser.add_option(
         '-f', '--file-storage', dest='fs', action='append',
         help='name=path, use the given file storage path for analysis of the.'
@@ -89,16 +161,43 @@ def gc_command(args=None, ptid=None, return_bad=False):
         '-u', '--untransform', dest='untransform',
         help='Function (module:expr) used to untransform data records in'
         ' files identified using the -file-storage/-f option')
+    _add_throttle_options(parser)
 
-    options, args = parser.parse_args(args)
 
-    if not args or len(args) > 2:
-        parser.parse_args(['-h'])
-    elif len(args) == 2:
-        conf2 = args[1]
-    else:
-        conf2 = None
+def _add_throttle_options(parser):
+    parser.add_option(
+        '-m', '--max-records', dest='max_records', type='float', default=0,
+        help='Maximum number of records to read per second. The default,'
+        ' 0, is unlimited.')
+    parser.add_option(
+        '-M', '--max-bytes', dest='max_bytes', type='float', default=0,
+        help='Maximum number of bytes of records to read per second. The'
+        ' default, 0, is unlimited.')
+    parser.add_option(
+        '-L', '--limits-file', dest='limits_file',
+        help='A file with lines like "records 1000" or "bytes 1000000",'
+        ' giving the maximum numbers of records and bytes to read per'
+        ' second. It is checked for changes while running.')
+
+
+def _throttle(options):
+    if options.max_records or options.max_bytes or options.limits_file:
+        return Throttle(options.max_records, options.max_bytes,
+                        options.limits_file)
 
+
+def _add_removal_options(parser):
+    parser.add_option(
+        '-D', '--bulk-delete', dest='bulk_delete', action='store_true',
+        help='Write delete records to file storages opened directly in'
+        ' large transactions, rather than in many small ones.')
+    parser.add_option(
+        '-p', '--pack', dest='pack', action='store_true',
+        help='Remove garbage from file storages by packing them to the'
+        ' analysis time, rather than by writing delete records.')
+
+
+def _setup_logging(options, level):
     if options.level:
         level = options.level
 
@@ -109,24 +208,27 @@ def gc_command(args=None, ptid=None, return_bad=False):
             level = getattr(logging, level)
         logging.basicConfig(level=level, format=log_format)
 
+
+def _untransform(options):
     untransform = options.untransform
     if untransform is not None:
         mod, expr = untransform.split(':', 1)
         untransform = eval(expr, __import__(mod, {}, {}, ['*']).__dict__)
-
-    return gc(args[0], options.days, options.ignore or (), conf2=conf2,
-              fs=dict(o.split('=') for o in options.fs or ()),
-              untransform=untransform, ptid=ptid, return_bad=return_bad)
+    return untransform
 
 
 def gc(conf, days=1, ignore=(), conf2=None, fs=(), untransform=None,
-       ptid=None, return_bad=False):
+       ptid=None, return_bad=False, read_ahead=0, current=False,
+       pack=False, bulk=False, throttle=None, summaries=None, only=None,
+       mapped=False, bulk_delete=False):
     # The programmatic entry point for running a GC. Internal function
     # only, all arguments and return values may change at any time.
     close = []
     result = None
     try:
-        bad = gc_(close, conf, days, ignore, conf2, fs, untransform, ptid)
+        bad = gc_(close, conf, days, ignore, conf2, fs, untransform, ptid,
+                  read_ahead, current, pack, bulk, throttle, summaries,
+                  only, mapped, bulk_delete)
         if return_bad:
             # For tests only, we return a sorted list of the human readable
             # pairs (dbname, badoid) when requested. Bad will be closed
@@ -135,15 +237,117 @@ def gc(conf, days=1, ignore=(), conf2=None, fs=(), untransform=None,
                             in bad.iterator())
         return result
     finally:
-        for thing in close:
-            if hasattr(thing, 'databases'):
-                for db in thing.databases.values():
-                    db.close()
-            elif hasattr(thing, 'close'):
-                thing.close()
+        _close(close)
+
+
+def _close(close):
+    for thing in close:
+        if hasattr(thing, 'databases'):
+            for db in thing.databases.values():
+                db.close()
+        elif hasattr(thing, 'close'):
+            thing.close()
+
 
+def gc_(close, conf, days, ignore, conf2, fs, untransform, ptid,
+        read_ahead=0, current=False, pack=False, bulk=False,
+        throttle=None, summaries=None, only=None, mapped=False,
+        bulk_delete=False):
+    iter_storage = _storage_iterator(close, fs, untransform, read_ahead,
+                                     current, bulk, throttle, mapped)
 
-def gc_(close, conf, days, ignore, conf2, fs, untransform, ptid):
+    with open(conf) as f:
+        db1 = ZODB.config.databaseFromFile(f)
+    close.append(db1)
+    if conf2 is None:
+        db2 = db1
+    else:
+        logger.info("Using secondary configuration, %s, for analysis", conf2)
+        with open(conf2) as f:
+            db2 = ZODB.config.databaseFromFile(f)
+        close.append(db2)
+        if set(db1.databases) != set(db2.databases):
+            raise ValueError("primary and secondary databases don't match.")
+
+    databases = db2.databases
+    storages = sorted((name, d.storage) for (name, d) in databases.items())
+
+    ptid = _ptid(ptid, days)
+
+    good = oidset(databases)
+    bad = Bad(databases)
+    close.append(bad)
+
+    deleted = oidset(databases)
+
+    # The last transactions read for each database.
+    tids = {}
+
+    if only is not None:
+        # Objects referenced from other databases, according to their
+        # summaries, aren't garbage.
+        if only not in databases:
+            raise ValueError("Unknown database, %r." % only)
+        for name, storage in storages:
+            if name != only:
+                tids[name], xrefs = _refresh_summary(
+                    summaries, name, storage, iter_storage, ignore)
+                for refs in xrefs.values():
+                    for ref in refs:
+                        if ref[0] == only:
+                            good.insert(*ref)
+        storages = [(only, databases[only].storage)]
+
+    xrefs = {}
+    for name, storage in storages:
+        tids[name] = z64
+        if summaries is not None:
+            xrefs[name] = {}
+
+    for name, storage in storages:
+        _scan_roots(name, storage, good, ignore)
+        if days:
+            tid = _scan_recent(name, storage, iter_storage, ptid,
+                               good, bad, deleted, ignore, xrefs.get(name))
+            tids[name] = max(tids[name], tid)
+
+    for name, storage in storages:
+        tid = _scan_old(name, storage, iter_storage, ptid,
+                        good, bad, deleted, ignore, xrefs.get(name))
+        tids[name] = max(tids[name], tid)
+
+    for name, oids in sorted(xrefs.items()):
+        for oid in [oid for oid in oids if deleted.has(name, oid)]:
+            del oids[oid]
+        _save_summary(_summary_path(summaries, name), name, tids[name],
+                      oids)
+
+    if conf2 is not None:
+        for db in db2.databases.values():
+            db.close()
+        close.remove(db2)
+
+    # Objects may have been written, or garbage referenced, since
+    # the databases were analyzed.
+    for name, tid in sorted(tids.items()):
+        _revalidate(name, db1.databases[name].storage, tid,
+                    good, bad, ignore)
+
+    # Now, we have the garbage in bad.  Remove it.
+    _remove_garbage(db1, bad, ptid if pack else None, bulk, only,
+                    bulk_delete)
+
+    return bad
+
+
+def _storage_iterator(close, fs, untransform, read_ahead=0, current=False,
+                      bulk=False, throttle=None, mapped=False):
+    # Return a function for iterating over a database's transactions,
+    # using file iterators for the databases named in fs.  If current
+    # is true, iterating over old transactions in files only provides
+    # the current records.  If bulk is true, RelStorages are read with
+    # bulk queries.  If a throttle is given, reading is limited by it.
+    # If mapped is true, the files are memory-mapped.
     if untransform is not None:
         def FileIterator(*args):
             def transit(trans):
@@ -162,128 +366,843 @@ def gc_(close, conf, days, ignore, conf2, fs, untransform, ptid):
 
     def iter_storage(name, storage, start=None, stop=None):
         fsname = name or ''
+        limit = throttle
         if fsname in fs:
-            it = FileIterator(fs[fsname], start, stop)
+            path = fs[fsname]
+            it = None
+            if current and start is None:
+                if os.path.exists(path + '.index'):
+                    try:
+                        it = CurrentIterator(path, stop, untransform)
+                    except ValueError:
+                        logger.warning(
+                            "%s: %s.index doesn't match %s, reading all"
+                            " revisions", fsname, path, path)
+                else:
+                    logger.warning(
+                        "%s: no index for %s, reading all revisions",
+                        fsname, path)
+            if it is None:
+                if mapped:
+                    it = MappedIterator(path, start, stop, untransform)
+                else:
+                    it = FileIterator(path, start, stop)
+        elif bulk and _is_relstorage(storage):
+            it = RelStorageIterator(storage, start, stop)
         else:
             it = storage.iterator(start, stop)
+            if read_ahead:
+                # Throttle the reading thread, rather than the analysis.
+                if limit is not None:
+                    it = ThrottledIterator(it, limit, fsname)
+                    limit = None
+                it = ReadAhead(it, read_ahead, fsname)
+        if limit is not None:
+            it = ThrottledIterator(it, limit, fsname)
         # We need to be sure to always close iterators
         # in case we raise an exception
         close.append(it)
         return it
 
-    with open(conf) as f:
-        db1 = ZODB.config.databaseFromFile(f)
-    close.append(db1)
-    if conf2 is None:
-        db2 = db1
-    else:
-        logger.info("Using secondary configuration, %s, for analysis", conf2)
-        with open(conf2) as f:
-            db2 = ZODB.config.databaseFromFile(f)
-        close.append(db2)
-        if set(db1.databases) != set(db2.databases):
-            raise ValueError("primary and secondary databases don't match.")
+    return iter_storage
 
-    databases = db2.databases
-    storages = sorted((name, d.storage) for (name, d) in databases.items())
 
-    if ptid is None:
-        ptid = TimeStamp.TimeStamp(
-            *time.gmtime(time.time() - 86400 * days)[:6]
-        ).raw()
+class CurrentIterator(ZODB.FileStorage.format.FileStorageFormatter):
+    """Iterate over the current records in a file storage.
 
-    good = oidset(databases)
-    bad = Bad(databases)
-    close.append(bad)
+    Only the current record of each object as of the stop transaction
+    id, if given, is provided. The records are found using the
+    file-storage index and read in file order, to keep reads
+    sequential.  They're provided in transactions, like the records
+    from a file iterator.
 
-    deleted = oidset(databases)
+    A ValueError is raised if the index doesn't match the file, as
+    when it was saved before the file was packed.
+    """
 
-    for name, storage in storages:
-        fsname = name or ''
-        logger.info("%s: roots", fsname)
-        # Make sure we can get the roots
-        data, s = storage.load(z64, '')
-        good.insert(name, z64)
-        for ref in getrefs(data, name, ignore):
-            good.insert(*ref)
+    def __init__(self, path, stop=None, untransform=None):
+        self._untransform = untransform
+        info = ZODB.fsIndex.fsIndex.load(path + '.index')
+        index = info['index']
+        self._file = open(path, 'rb')
+        try:
+            ltid = self._check_index(index, info['pos'])
+        except BaseException:
+            self._file.close()
+            raise
+        if ltid is None or ltid != info.get('ltid', ltid):
+            self._file.close()
+            raise ValueError("The index doesn't match the file", path)
+
+        # Catch up with transactions committed after the index was saved.
+        it = ZODB.FileStorage.FileIterator(path, pos=info['pos'])
+        try:
+            for trans in it:
+                for record in trans:
+                    index[record.oid] = record.pos
+        finally:
+            it.close()
+
+        # Records at or after end were committed after stop.
+        end = None
+        if stop is not None:
+            it = ZODB.FileStorage.FileIterator(path, p64(u64(stop) + 1))
+            try:
+                for trans in it:
+                    for record in trans:
+                        end = record.pos
+                        break
+                    if end is not None:
+                        break
+            finally:
+                it.close()
+
+        self._positions = positions = BTrees.LLBTree.TreeSet()
+        for oid, pos in index.items():
+            while end is not None and pos >= end:
+                # Use the revision current as of stop, if any.
+                pos = self._read_data_header(pos, oid).prev
+            if pos:
+                positions.insert(pos)
+
+    def _check_index(self, index, pos, max_checked=5):
+        # Check the records of the last transaction before pos that
+        # wasn't undone against the index, as file storages do before
+        # using a saved index.  Return the id of the last transaction,
+        # or None if they don't match.
+        f = self._file
+        f.seek(0, 2)
+        if pos < 100 or f.tell() < pos:
+            return None
+        ltid = None
+        while True:
+            f.seek(pos - 8)
+            tl = u64(f.read(8))
+            pos = pos - tl - 8
+            if pos < 4:
+                return None
+            h = self._read_txn_header(pos)
+            if ltid is None:
+                ltid = h.tid
+            if h.tlen != tl:
+                return None
+            if h.status == 'u':
+                continue
+            if h.status not in ' p' or tl < h.headerlen():
+                return None
+            tend = pos + tl
+            opos = pos + h.headerlen()
+            if opos == tend:
+                continue
+            checked = 0
+            while opos < tend and checked < max_checked:
+                h = self._read_data_header(opos)
+                if opos + h.recordlen() > tend or h.tloc != pos:
+                    return None
+                if index.get(h.oid, 0) != opos:
+                    return None
+                checked += 1
+                opos += h.recordlen()
+            return ltid
+
+    def __iter__(self):
+        records = []
+        for pos in self._positions:
+            h = self._read_data_header(pos)
+            if h.plen:
+                data = self._file.read(h.plen)
+            elif h.back:
+                data = self._loadBack_impl(h.oid, h.back, False)[0]
+            else:
+                data = None
+            if data and self._untransform is not None:
+                data = self._untransform(data)
+            if records and records[-1].tid != h.tid:
+                yield records
+                records = []
+            records.append(
+                ZODB.FileStorage.Record(h.oid, h.tid, data, None, pos))
+        if records:
+            yield records
 
-        n = 0
-        if days:
-            # All non-deleted new records are good
-            logger.info("%s: recent", name)
+    def close(self):
+        self._file.close()
 
-            for trans in iter_storage(name, storage, start=ptid):
-                for record in trans:
-                    if n and n % 10000 == 0:
-                        logger.info("%s: %s recent", name, n)
-                    n += 1
-
-                    oid = record.oid
-                    data = record.data
-                    if data:
-                        if deleted.has(name, oid):
-                            raise AssertionError(
-                                "Non-deleted record after deleted")
-                        good.insert(name, oid)
-
-                        # and anything they reference
-                        for ref_name, ref_oid in getrefs(data, name, ignore):
-                            if not deleted.has(ref_name, ref_oid):
-                                good.insert(ref_name, ref_oid)
-                                bad.remove(ref_name, ref_oid)
-                    else:
-                        # deleted record
-                        deleted.insert(name, oid)
-                        good.remove(name, oid)
 
-    for name, storage in storages:
-        # Now iterate over older records
-        for trans in iter_storage(name, storage, start=None, stop=ptid):
-            for record in trans:
-                if n and n % 10000 == 0:
-                    logger.info("%s: %s old", name, n)
-                n += 1
+MappedRecord = collections.namedtuple('MappedRecord', 'oid tid data')
+
+
+class MappedIterator:
+    """Iterate over the transactions in a file storage, memory-mapping it.
 
-                oid = record.oid
-                data = record.data
-                if data:
-                    if deleted.has(name, oid):
-                        continue
-                    if good.has(name, oid):
-                        for ref in getrefs(data, name, ignore):
-                            if deleted.has(*ref):
-                                continue
-                            if good.insert(*ref) and bad.has(*ref):
-                                to_do = [ref]
-                                while to_do:
-                                    for ref in bad.pop(*to_do.pop()):
-                                        if good.insert(*ref) and bad.has(*ref):
-                                            to_do.append(ref)
+    Transaction and data headers are parsed in place, and transactions
+    are provided as lists of (oid, tid, data) records, where data is a
+    memoryview of the pickle in the mapped file, following
+    backpointers, or None for delete records.  The iterator copies
+    nothing unless records are untransformed, but getrefs copies the
+    pickles it reads.
+    """
+
+    def __init__(self, path, start=None, stop=None, untransform=None):
+        self._path = path
+        self._start = start
+        self._stop = stop
+        self._untransform = untransform
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+        # Files written under Python 2 have an older magic number.
+        if self._map[:4] not in (ZODB.FileStorage.packed_version, b'FS21'):
+            self.close()
+            raise ValueError("Not a file storage", path)
+
+    def __iter__(self):
+        m = self._map
+        buf = memoryview(m)
+        try:
+            yield from self._transactions(m, buf)
+        finally:
+            buf.release()
+
+    def _transactions(self, m, buf):
+        unpack_from = struct.unpack_from
+        trans_hdr = ZODB.FileStorage.format.TRANS_HDR
+        trans_hdr_len = ZODB.FileStorage.format.TRANS_HDR_LEN
+        data_hdr = ZODB.FileStorage.format.DATA_HDR
+        data_hdr_len = ZODB.FileStorage.format.DATA_HDR_LEN
+        start = self._start
+        stop = self._stop
+        untransform = self._untransform
+        end = len(m)
+        pos = 4 if start is None else self._start_pos(m, start)
+        while pos + trans_hdr_len <= end:
+            tid, tlen, status, ulen, dlen, elen = unpack_from(
+                trans_hdr, m, pos)
+            if stop is not None and tid > stop:
+                break
+            if status == b'c':
+                # The last, in-progress transaction
+                break
+            tend = pos + tlen
+            if (tend + 8 > end or tlen < trans_hdr_len
+                    or unpack_from('>Q', m, tend)[0] != tlen):
+                logger.warning("%s truncated or damaged at %s",
+                               self._path, pos)
+                break
+            if status != b'u' and (start is None or tid >= start):
+                records = []
+                rpos = pos + trans_hdr_len + ulen + dlen + elen
+                while rpos < tend:
+                    oid, rtid, _, _, vlen, plen = unpack_from(
+                        data_hdr, m, rpos)
+                    if vlen:
+                        raise ValueError("Versions aren't supported",
+                                         self._path, rpos)
+                    rpos += data_hdr_len
+                    if plen:
+                        data = buf[rpos:rpos + plen]
+                        rpos += plen
                     else:
-                        bad.insert(name, oid, record.tid,
-                                   getrefs(data, name, ignore))
+                        back, = unpack_from('>Q', m, rpos)
+                        data = self._back(m, buf, back)
+                        rpos += 8
+                    if data and untransform is not None:
+                        data = untransform(bytes(data))
+                    records.append(MappedRecord(oid, rtid, data))
+                yield records
+            pos = tend + 8
+
+    def _start_pos(self, m, start):
+        # Find the first transaction at or after start, searching
+        # backward from the last transaction if start is nearer the
+        # end, as file iterators do.  Transactions before start are
+        # skipped by reading forward otherwise.
+        end = len(m)
+        if end < 4 + 8:
+            return 4
+        tid1 = m[4:12]
+        if start <= tid1:
+            return 4
+        # The transaction length is repeated after each transaction.
+        # If the last one is still being written, read forward.
+        tlen, = struct.unpack_from('>Q', m, end - 8)
+        pos2 = end - tlen - 8
+        if (pos2 < 4 or struct.unpack_from(
+                '>Q', m, pos2 + 8)[0] != tlen):
+            return 4
+        tid2 = m[pos2:pos2 + 8]
+        if start > tid2:
+            return end
+        t1 = TimeStamp.TimeStamp(tid1).timeTime()
+        t2 = TimeStamp.TimeStamp(tid2).timeTime()
+        ts = TimeStamp.TimeStamp(start).timeTime()
+        if ts - t1 < t2 - ts:
+            return 4
+        pos = pos2
+        while pos > 4:
+            tlen, = struct.unpack_from('>Q', m, pos - 8)
+            prev = pos - tlen - 8
+            if prev < 4 or m[prev:prev + 8] < start:
+                break
+            pos = prev
+        return pos
+
+    def _back(self, m, buf, back):
+        # Follow a chain of backpointers to a pickle.  The pickle
+        # length is the last field of the data header.
+        data_hdr_len = ZODB.FileStorage.format.DATA_HDR_LEN
+        while back:
+            pos = back + data_hdr_len
+            plen, = struct.unpack_from('>Q', m, pos - 8)
+            if plen:
+                return buf[pos:pos + plen]
+            back, = struct.unpack_from('>Q', m, pos)
+        return None
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Records still refer to the file. It will be closed when
+            # they're gone.
+            pass
+        self._file.close()
+
+
+def _is_relstorage(storage):
+    # RelStorage is an optional dependency, so check for its adapter
+    # rather than importing it.
+    return hasattr(storage, '_adapter') and hasattr(storage, 'keep_history')
+
+
+class RelStorageIterator:
+    """Iterate over the records of a RelStorage with a single query.
+
+    Rather than querying the transactions and then the records of
+    each, as the storage's iterator does, the records between start
+    and stop are selected in transaction order by one query, read in
+    batches with a server-side cursor and grouped into transactions.
+    The storage's load connection is used, so all of the passes over
+    the storage see the same snapshot.
+    """
+
+    _stmt = (
+        "SELECT zoid, tid, state FROM object_state"
+        " WHERE tid >= %(min_tid)s AND tid <= %(max_tid)s"
+        " ORDER BY tid, zoid")
+
+    def __init__(self, storage, start=None, stop=None, batch_size=1000):
+        self._storage = storage
+        self._params = dict(
+            min_tid=u64(start) if start else 0,
+            max_tid=u64(stop) if stop else (1 << 63) - 1,
+        )
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        adapter = self._storage._adapter
+        as_state = adapter.driver.binary_column_as_state_type
+        with self._storage._load_connection.server_side_cursor() as cursor:
+            adapter.runner.run_script_stmt(cursor, self._stmt, self._params)
+            records = []
+            while 1:
+                rows = cursor.fetchmany(self._batch_size)
+                if not rows:
+                    break
+                for zoid, tid, state in rows:
+                    tid = p64(tid)
+                    if records and records[-1].tid != tid:
+                        yield records
+                        records = []
+                    records.append(ZODB.BaseStorage.DataRecord(
+                        p64(zoid), tid, as_state(state), None))
+            if records:
+                yield records
 
+    def close(self):
+        pass
+
+
+class ReadAhead:
+    """Iterate over a storage iterator, reading ahead in a thread.
+
+    Up to depth transactions, with their records, are prefetched while
+    the caller processes earlier ones.  Stall counts tell which side
+    is the bottleneck: producer stalls are waits for room in a full
+    queue and consumer stalls are waits for data from an empty one.
+    """
+
+    _done = object()
+
+    def __init__(self, it, depth, name=''):
+        self._it = it
+        self._name = name
+        self._queue = queue.Queue(depth)
+        self._closed = False
+        self._finished = False
+        self.producer_stalls = self.consumer_stalls = 0
+        self._thread = threading.Thread(
+            target=self._run, name='read-ahead %s' % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for trans in self._it:
+                if not self._put(_PrefetchedTransaction(trans)):
+                    return
+        except Exception as v:
+            self._put(_PrefetchError(v))
+        else:
+            self._put(self._done)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.producer_stalls += 1
+            while not self._closed:
+                try:
+                    self._queue.put(item, timeout=.1)
+                except queue.Full:
+                    pass
                 else:
-                    # deleted record
-                    if good.has(name, oid):
-                        good.remove(name, oid)
-                    elif bad.has(name, oid):
-                        bad.remove(name, oid)
-                    deleted.insert(name, oid)
+                    break
+            else:
+                return False
+        return True
 
-    if conf2 is not None:
-        for db in db2.databases.values():
-            db.close()
-        close.remove(db2)
+    def __iter__(self):
+        return self
 
-    # Now, we have the garbage in bad.  Remove it.
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            self.consumer_stalls += 1
+            item = self._queue.get()
+        if item is self._done:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _PrefetchError):
+            self._finished = True
+            raise item.error
+        return item
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._thread.join()
+        logger.info("%s: read-ahead stalls, producer %s, consumer %s",
+                    self._name, self.producer_stalls, self.consumer_stalls)
+        if hasattr(self._it, 'close'):
+            self._it.close()
+
+
+class Throttle:
+    """Limit the rates of reading records and bytes, with token buckets.
+
+    A rate of 0 is unlimited.  Up to a second's worth of records and
+    bytes can be read in a burst.  If a limits file is given, it's
+    checked for changes at most once a second, so the rates can be
+    changed while running.  It has lines like ``records 1000`` and
+    ``bytes 10000000``, giving new rates.
+    """
+
+    def __init__(self, records_per_second=0, bytes_per_second=0,
+                 path=None):
+        self.rates = [records_per_second or 0, bytes_per_second or 0]
+        self._tokens = list(self.rates)
+        self._path = path
+        self._mtime = None
+        self._checked = self._last = time.monotonic()
+        self.records = self.bytes = 0
+        self.waited = 0.0
+        if path:
+            self._read_limits()
+
+    def consume(self, records, nbytes):
+        # Account for records and bytes read, waiting if they exceed
+        # the limits.
+        self.records += records
+        self.bytes += nbytes
+        now = time.monotonic()
+        if self._path and now - self._checked >= 1:
+            self._checked = now
+            self._read_limits()
+        elapsed = now - self._last
+        self._last = now
+        wait = 0.0
+        for i, amount in enumerate((records, nbytes)):
+            rate = self.rates[i]
+            if rate:
+                tokens = min(rate, self._tokens[i] + elapsed * rate) - amount
+                self._tokens[i] = tokens
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+        if wait:
+            time.sleep(wait)
+            self.waited += wait
+            self._last += wait
+            for i, rate in enumerate(self.rates):
+                self._tokens[i] = min(rate, self._tokens[i] + wait * rate)
+
+    def _read_limits(self):
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        with open(self._path) as f:
+            for line in f:
+                words = line.split()
+                if not words or words[0].startswith('#'):
+                    continue
+                try:
+                    kind, rate = words
+                    i = ('records', 'bytes').index(kind)
+                    rate = float(rate)
+                except ValueError:
+                    logger.warning("Bad line in %s: %r", self._path, line)
+                    continue
+                self.rates[i] = rate
+                self._tokens[i] = min(self._tokens[i], rate)
+        logger.info("Limits: %s records and %s bytes per second",
+                    *self.rates)
+
+    def snapshot(self):
+        return self.records, self.bytes, self.waited, time.monotonic()
+
+    def report(self, name, since):
+        # Log the throughput achieved since a snapshot.
+        records, nbytes, waited, start = since
+        records = self.records - records
+        nbytes = self.bytes - nbytes
+        elapsed = max(time.monotonic() - start, 1e-6)
+        logger.info("%s: read %s records, %s bytes in %.1f seconds,"
+                    " %.0f records/s, %.0f bytes/s, %.1f seconds waiting",
+                    name, records, nbytes, elapsed, records / elapsed,
+                    nbytes / elapsed, self.waited - waited)
+
+
+class ThrottledIterator:
+    """Iterate over a storage iterator, limiting the rate of reading.
+
+    The throughput is logged when the iterator is exhausted or closed.
+    """
+
+    def __init__(self, it, throttle, name=''):
+        self._it = it
+        self._throttle = throttle
+        self._name = name
+        self._since = throttle.snapshot()
+
+    def __iter__(self):
+        for trans in self._it:
+            trans = _PrefetchedTransaction(trans)
+            self._throttle.consume(
+                len(trans._records),
+                sum(len(record.data) for record in trans._records
+                    if record.data))
+            yield trans
+        self._report()
+
+    def _report(self):
+        if self._since is not None:
+            self._throttle.report(self._name, self._since)
+            self._since = None
+
+    def close(self):
+        self._report()
+        if hasattr(self._it, 'close'):
+            self._it.close()
+
+
+class _PrefetchedTransaction:
+
+    def __init__(self, trans):
+        self._trans = trans
+        self._records = list(trans)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __getattr__(self, name):
+        return getattr(self._trans, name)
+
+
+class _PrefetchError:
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _ptid(ptid, days):
+    if ptid is None:
+        ptid = TimeStamp.TimeStamp(
+            *time.gmtime(time.time() - 86400 * days)[:6]
+        ).raw()
+    return ptid
+
+
+def _scan_roots(name, storage, good, ignore):
+    fsname = name or ''
+    logger.info("%s: roots", fsname)
+    # Make sure we can get the roots
+    data, s = storage.load(z64, '')
+    good.insert(name, z64)
+    for ref in getrefs(data, name, ignore):
+        good.insert(*ref)
+
+
+def _scan_recent(name, storage, iter_storage, ptid,
+                 good, bad, deleted, ignore, xrefs=None):
+    # All non-deleted new records are good.  If xrefs is given, the
+    # references to other databases are noted in it.  Return the id of
+    # the last transaction read.
+    logger.info("%s: recent", name)
+
+    n = 0
+    last = z64
+    for trans in iter_storage(name, storage, start=ptid):
+        for record in trans:
+            if n and n % 10000 == 0:
+                logger.info("%s: %s recent", name, n)
+            n += 1
+            last = record.tid
+
+            oid = record.oid
+            data = record.data
+            if data:
+                if deleted.has(name, oid):
+                    raise AssertionError(
+                        "Non-deleted record after deleted")
+                good.insert(name, oid)
+
+                # and anything they reference
+                refs = list(getrefs(data, name, ignore))
+                if xrefs is not None:
+                    _note_xrefs(xrefs, name, oid, refs)
+                for ref_name, ref_oid in refs:
+                    if not deleted.has(ref_name, ref_oid):
+                        good.insert(ref_name, ref_oid)
+                        bad.remove(ref_name, ref_oid)
+            else:
+                # deleted record
+                deleted.insert(name, oid)
+                good.remove(name, oid)
+    return last
+
+
+def _scan_old(name, storage, iter_storage, ptid,
+              good, bad, deleted, ignore, xrefs=None):
+    # Now iterate over older records, returning the id of the last
+    # transaction read.
+    n = 0
+    last = z64
+    for trans in iter_storage(name, storage, start=None, stop=ptid):
+        for record in trans:
+            if n and n % 10000 == 0:
+                logger.info("%s: %s old", name, n)
+            n += 1
+            last = max(last, record.tid)
+
+            oid = record.oid
+            data = record.data
+            if data:
+                if deleted.has(name, oid):
+                    continue
+                refs = list(getrefs(data, name, ignore))
+                if xrefs is not None:
+                    _note_xrefs(xrefs, name, oid, refs)
+                if good.has(name, oid):
+                    for ref in refs:
+                        if deleted.has(*ref):
+                            continue
+                        if good.insert(*ref) and bad.has(*ref):
+                            _rescue(ref, good, bad)
+                else:
+                    bad.insert(name, oid, record.tid, refs)
+
+            else:
+                # deleted record
+                if good.has(name, oid):
+                    good.remove(name, oid)
+                elif bad.has(name, oid):
+                    bad.remove(name, oid)
+                deleted.insert(name, oid)
+    return last
+
+
+def _rescue(ref, good, bad):
+    # ref was garbage candidate that has just become good. So is
+    # everything it references.  Return the number of candidates
+    # rescued.
+    to_do = [ref]
+    rescued = 0
+    while to_do:
+        rescued += 1
+        for ref in bad.pop(*to_do.pop()):
+            if good.insert(*ref) and bad.has(*ref):
+                to_do.append(ref)
+    return rescued
+
+
+def _revalidate(name, storage, tid, good, bad, ignore):
+    # Read the transactions committed after tid and drop the garbage
+    # candidates written or referenced in them, and anything
+    # referenced by the referenced candidates.
+    written = referenced = 0
+    it = storage.iterator(p64(u64(tid) + 1))
+    try:
+        for trans in it:
+            for record in trans:
+                if bad.has(name, record.oid):
+                    bad.remove(name, record.oid)
+                    written += 1
+                if record.data:
+                    for ref in getrefs(record.data, name, ignore):
+                        if bad.has(*ref):
+                            referenced += _rescue(ref, good, bad)
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+    if written or referenced:
+        logger.info("%s: kept %s garbage objects written and %s referenced"
+                    " since %s", name, written, referenced,
+                    TimeStamp.TimeStamp(tid))
+
+
+def _note_xrefs(xrefs, name, oid, refs):
+    # Remember the references an object makes to other databases, in
+    # any of its revisions.
+    refs = [ref for ref in refs if ref[0] != name]
+    if refs:
+        oid_refs = xrefs.get(oid)
+        if oid_refs is None:
+            oid_refs = xrefs[oid] = set()
+        oid_refs.update(refs)
+
+
+_summary_magic = 'zc.zodbdgc summary 1'
+
+
+def _summary_path(directory, name):
+    return os.path.join(directory, name + '.xrefs')
+
+
+def _save_summary(path, name, tid, xrefs):
+    # The file has a header with the database name and the last
+    # transaction id scanned, followed by the objects with references
+    # to other databases and their references.
+    logger.info("%s: save summary in %s", name, path)
+    with open(path + '.tmp', 'wb') as f:
+        marshal.dump((_summary_magic, name, tid), f)
+        for oid, refs in sorted(xrefs.items()):
+            marshal.dump((oid, sorted(refs)), f)
+    os.replace(path + '.tmp', path)
+
+
+def _load_summary(f, name):
+    header = marshal.load(f)
+    if not (isinstance(header, tuple) and header[0] == _summary_magic
+            and header[1] == name):
+        raise ValueError("Not a summary for %r" % name, f.name)
+    xrefs = {}
+    while 1:
+        try:
+            oid, refs = marshal.load(f)
+        except EOFError:
+            break
+        xrefs[oid] = set(tuple(ref) for ref in refs)
+    return header[2], xrefs
+
+
+def _refresh_summary(directory, name, storage, iter_storage, ignore):
+    # Load the summary of the references from the named database to
+    # other databases, bring it up to date with the transactions
+    # committed since it was saved, and save it again.  Return the id
+    # of the last transaction it covers and the summary.
+    path = _summary_path(directory, name)
+    if not os.path.exists(path):
+        raise ValueError(
+            "No summary for %r, a full collection saving summaries"
+            " is needed first." % name)
+    with open(path, 'rb') as f:
+        tid, xrefs = _load_summary(f, name)
+    last = storage.lastTransaction()
+    if last < tid:
+        # The references removed from the summary since may be back.
+        raise ValueError(
+            "%r is older than its summary, a full collection saving"
+            " summaries is needed." % name)
+    if last == tid:
+        return tid, xrefs
+    logger.info("%s: update summary from %s", name, TimeStamp.TimeStamp(tid))
+    # The storage may be read from a file that's behind it, so the
+    # summary only covers the transactions actually read.
+    last = tid
+    for trans in iter_storage(name, storage, start=p64(u64(tid) + 1)):
+        for record in trans:
+            last = record.tid
+            if record.data:
+                _note_xrefs(xrefs, name, record.oid,
+                            getrefs(record.data, name, ignore))
+            else:
+                xrefs.pop(record.oid, None)
+    if last != tid:
+        _save_summary(path, name, last, xrefs)
+    return last, xrefs
+
+
+# The description of the transactions writing delete records for
+# garbage, so checks can tell them from other deletes.
+_remove_garbage_description = b'zc.zodbdgc: remove garbage'
+
+
+def _remove_garbage(db, bad, pack_tid=None, bulk=False, only=None,
+                    bulk_delete=False):
+    # Write delete records for the garbage or, if pack_tid is given,
+    # remove it from file storages by packing to pack_tid.  If bulk is
+    # true, garbage is deleted from history-free RelStorages in batches.
+    # If bulk_delete is true, delete records are written to file
+    # storages in large transactions.  If only is given, only the named
+    # database is changed.
     batch_size = 100
-    for name, db in sorted(db1.databases.items()):
+    for name, d in sorted(db.databases.items()):
+        if only is not None and name != only:
+            continue
         logger.info("%s: remove garbage", name)
-        storage = db.storage
+        storage = d.storage
+        if bulk and _is_relstorage(storage) and not storage.keep_history:
+            nd = _delete_relstorage_garbage(storage, bad.iterator(name))
+            logger.info("Removed %s objects from %s", nd, name)
+            continue
+        if (pack_tid is not None
+                and isinstance(storage, ZODB.FileStorage.FileStorage)):
+            nd = _pack_garbage(storage, bad.iterator(name), pack_tid)
+            if nd is not None:
+                logger.info("Removed %s objects from %s", nd, name)
+                continue
+            logger.info("%s: already packed, writing delete records", name)
+        if bulk_delete and isinstance(storage,
+                                      ZODB.FileStorage.FileStorage):
+            nd = _delete_filestorage_garbage(storage, bad.iterator(name))
+            logger.info("Removed %s objects from %s", nd, name)
+            continue
         nd = 0
         t = transaction.begin()
-        txn_meta = TransactionMetaData()
+        txn_meta = TransactionMetaData(
+            description=_remove_garbage_description)
         storage.tpc_begin(txn_meta)
         start = time.time()
         for oid, tid in bad.iterator(name):
@@ -302,7 +1221,8 @@ def gc_(close, conf, days, ignore, conf2, fs, untransform, ptid):
                 time.sleep(duration * 2)
                 batch_size = max(10, int(batch_size * .5 / duration))
                 t = transaction.begin()
-                txn_meta = TransactionMetaData()
+                txn_meta = TransactionMetaData(
+                    description=_remove_garbage_description)
                 storage.tpc_begin(txn_meta)
                 start = time.time()
 
@@ -315,7 +1235,180 @@ def gc_(close, conf, days, ignore, conf2, fs, untransform, ptid):
             storage.tpc_abort(txn_meta)
             t.abort()
 
-    return bad
+
+def _pack_garbage(storage, garbage, pack_tid):
+    # Pack the file storage to pack_tid, leaving out the garbage
+    # (oid, tid) pairs, rather than doing its own garbage collection.
+    # Return the number of objects removed, or None if the storage has
+    # already been packed to a later time.
+    removed = []
+
+    def packer(storage, referencesf, stop, gc):
+        p = GarbagePacker(storage, referencesf, stop, garbage)
+        try:
+            opos = p.pack()
+            removed.append(p.gc.removed)
+            if opos is None:
+                return None
+            return opos, p.index
+        finally:
+            p.close()
+
+    had_packer = 'packer' in storage.__dict__
+    old_packer = storage.packer
+    storage.packer = packer
+    try:
+        storage.pack(TimeStamp.TimeStamp(pack_tid).timeTime(),
+                     ZODB.serialize.referencesf)
+    finally:
+        if had_packer:
+            storage.packer = old_packer
+        else:
+            del storage.packer
+
+    if removed:
+        return removed[0]
+
+
+def _delete_filestorage_garbage(storage, garbage, batch_size=10000):
+    # Write delete records for the garbage (oid, tid) pairs to a file
+    # storage, a large batch per transaction, so there's one fsync and
+    # index update per batch, rather than per few records.  The
+    # storage's commit lock is held while writing each batch.  Return
+    # the number of objects deleted.
+    nd = 0
+    batch = []
+    for oid, tid in garbage:
+        batch.append((oid, tid))
+        if len(batch) == batch_size:
+            nd += _delete_file_records(storage, batch)
+            logger.info("%s: deleted %s", storage.getName(), nd)
+            batch = []
+    if batch:
+        nd += _delete_file_records(storage, batch)
+    return nd
+
+
+def _delete_file_records(storage, batch):
+    # Checking that an object hasn't been written since the analysis
+    # reads its current data header, so do the deletes in file order.
+    index = storage._index
+    batch.sort(key=lambda item: index.get(item[0], 0))
+    txn_meta = TransactionMetaData(description=_remove_garbage_description)
+    storage.tpc_begin(txn_meta)
+    try:
+        deleted = 0
+        for oid, tid in batch:
+            try:
+                storage.deleteObject(oid, tid, txn_meta)
+            except (ZODB.POSException.POSKeyError,
+                    ZODB.POSException.ConflictError):
+                continue
+            deleted += 1
+        if deleted:
+            storage.tpc_vote(txn_meta)
+            storage.tpc_finish(txn_meta)
+        else:
+            storage.tpc_abort(txn_meta)
+    except BaseException:
+        storage.tpc_abort(txn_meta)
+        raise
+    return deleted
+
+
+def _delete_relstorage_garbage(storage, garbage, batch_size=1000):
+    # Delete the garbage (oid, tid) pairs from a history-free
+    # RelStorage, a batch of rows per statement and transaction,
+    # holding the commit lock.  A row is only deleted if the object
+    # hasn't been written since the analysis.  Return the number of
+    # objects deleted.
+    adapter = storage._adapter
+    conn, cursor = adapter.connmanager.open_for_store()
+    try:
+        nd = 0
+        batch = []
+        for oid, tid in garbage:
+            batch.append((u64(oid), u64(tid)))
+            if len(batch) == batch_size:
+                nd += _delete_relstorage_rows(adapter, conn, cursor, batch)
+                batch = []
+        if batch:
+            nd += _delete_relstorage_rows(adapter, conn, cursor, batch)
+        return nd
+    finally:
+        adapter.connmanager.close(conn, cursor)
+
+
+def _delete_relstorage_rows(adapter, conn, cursor, rows):
+    adapter.locker.hold_commit_lock(cursor, ensure_current=True)
+    try:
+        # The batcher flushes, with a single statement, when it would
+        # exceed the database's limit on bind parameters.
+        batcher = adapter.locker.make_batcher(cursor, len(rows))
+        deleted = 0
+        for zoid, tid in rows:
+            if batcher.delete_from('object_state', zoid=zoid, tid=tid):
+                deleted += cursor.rowcount
+        if batcher.flush():
+            deleted += cursor.rowcount
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        adapter.locker.release_commit_lock(cursor)
+    logger.debug("deleted %s of %s rows", deleted, len(rows))
+    return deleted
+
+
+class GarbagePacker(ZODB.FileStorage.fspack.FileStoragePacker):
+    """Pack a file storage, leaving out garbage found by analysis.
+
+    Records current at the pack time are kept, except for the records
+    of garbage objects.  A garbage object is only left out if its
+    current record is the one analyzed and it wasn't written after the
+    pack time.
+    """
+
+    def __init__(self, storage, referencesf, stop, garbage):
+        ZODB.FileStorage.fspack.FileStoragePacker.__init__(
+            self, storage, referencesf, stop, False)
+        self.gc = GarbageGC(
+            self._file, self.file_end, self._stop, garbage, referencesf)
+
+
+class GarbageGC(ZODB.FileStorage.fspack.GC):
+
+    def __init__(self, file, eof, packtime, garbage, referencesf):
+        ZODB.FileStorage.fspack.GC.__init__(
+            self, file, eof, packtime, False, referencesf)
+        self.garbage = garbage
+        self.removed = 0
+
+    def findReachable(self):
+        ZODB.FileStorage.fspack.GC.findReachable(self)
+        reachable = self.reachable
+        written = self.writtenAfterPacktime()
+        for oid, tid in self.garbage:
+            pos = reachable.get(oid)
+            if (pos is not None and oid not in written
+                    and self._read_data_header(pos, oid).tid == tid):
+                del reachable[oid]
+                self.removed += 1
+
+    def writtenAfterPacktime(self):
+        written = ZODB.fsIndex.fsIndex()
+        pos = self.packpos
+        while pos < self.eof:
+            th = self._read_txn_header(pos)
+            end = pos + th.tlen
+            pos += th.headerlen()
+            while pos < end:
+                dh = self._read_data_header(pos)
+                written[dh.oid] = pos
+                pos += dh.recordlen()
+            pos += 8
+        return written
 
 
 def getrefs(p, rname, ignore):
@@ -468,6 +1561,13 @@ class Bad:
                 f.seek(pos)
                 yield oid, f.read(8)
 
+    def items(self, name):
+        f = self._file
+        for oid, pos in self._dbs[name].items():
+            f.seek(pos)
+            tid = f.read(8)
+            yield oid, tid, marshal.load(f)
+
     def insert(self, name, oid, tid, refs):
         assert len(tid) == 8
         f = self._file
@@ -502,15 +1602,284 @@ class Bad:
         return marshal.load(f)
 
 
-def check(config, refdb=None):
-    if refdb is None:
-        return check_(config)
+# Distributed analysis. Each database is analyzed by a worker, typically
+# on the machine that holds its storage, which saves a partial result
+# to a file.  The partial results are merged to find the global garbage.
+
+_partial_magic = 'zc.zodbdgc partial 1'
 
-    fs = ZODB.FileStorage.FileStorage(refdb, create=True)
-    conn = ZODB.connection(fs)
-    references = conn.root.references = BTrees.OOBTree.BTree()
+
+def worker_command(args=None, ptid=None):
+    # The setuptools entry point for analyzing a single database.
+    # Arguments are for internal use only and may change at any time.
+
+    if args is None:
+        args = sys.argv[1:]
+        level = logging.WARNING
+    else:
+        level = None
+
+    parser = optparse.OptionParser(
+        "usage: %prog [options] config database output")
+    _add_analysis_options(parser)
+    parser.add_option(
+        '-T', '--analysis-time', dest='analysis_time',
+        help='The analysis time, as a UTC date and time like'
+        ' 2024-01-31T12:00:00, rather than --days before now. Give all'
+        ' of the workers the same time, so their partial results can be'
+        ' merged consistently.')
+
+    options, args = parser.parse_args(args)
+
+    if len(args) != 3:
+        parser.parse_args(['-h'])
+
+    if options.analysis_time:
+        try:
+            t = time.strptime(options.analysis_time, '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            parser.error("Invalid --analysis-time, %r"
+                         % options.analysis_time)
+        ptid = TimeStamp.TimeStamp(*t[:6]).raw()
+
+    _setup_logging(options, level)
+
+    conf, name, output = args
+    worker(conf, name, output, options.days, options.ignore or (),
+           fs=dict(o.split('=') for o in options.fs or ()),
+           untransform=_untransform(options), ptid=ptid,
+           read_ahead=options.read_ahead, current=options.current,
+           bulk=options.bulk, throttle=_throttle(options),
+           mapped=options.mapped)
+
+
+def worker(conf, name, output, days=1, ignore=(), fs=(), untransform=None,
+           ptid=None, read_ahead=0, current=False, bulk=False,
+           throttle=None, mapped=False):
+    # Analyze the named database and save the partial result to the
+    # output file. Internal function only, all arguments may change at
+    # any time.
+    close = []
+    try:
+        iter_storage = _storage_iterator(close, fs, untransform, read_ahead,
+                                         current, bulk, throttle, mapped)
+
+        # Only open the database we're analyzing. The others may not
+        # be available here.
+        with open(conf) as f:
+            config, _ = ZConfig.loadConfigFile(ZODB.config.getDbSchema(), f)
+        factories = {
+            (factory.config.database_name or factory.name or ''): factory
+            for factory in config.database}
+        if name not in factories:
+            raise ValueError("Unknown database, %r." % name)
+        db = factories[name].open()
+        close.append(db)
+        storage = db.storage
+
+        ptid = _ptid(ptid, days)
+
+        good = oidset(factories)
+        bad = Bad(factories)
+        close.append(bad)
+        deleted = oidset(factories)
+
+        _scan_roots(name, storage, good, ignore)
+        tid = z64
+        if days:
+            tid = _scan_recent(name, storage, iter_storage, ptid,
+                               good, bad, deleted, ignore)
+        tid = max(tid, _scan_old(name, storage, iter_storage, ptid,
+                                 good, bad, deleted, ignore))
+
+        logger.info("%s: save partial result in %s", name, output)
+        with open(output, 'wb') as f:
+            _save_partial(f, name, ptid, tid, ignore, good, deleted, bad)
+    finally:
+        _close(close)
+
+
+def _save_partial(f, name, ptid, tid, ignore, good, deleted, bad):
+    # The file is a sequence of marshal records, starting with a
+    # header with the analysis time, the last transaction read and
+    # the ignored databases.  Good and deleted oids are saved a prefix
+    # at a time.  The good oids include the oids in other databases
+    # referenced by good objects.
+    marshal.dump((_partial_magic, name, ptid, tid, list(ignore)), f)
+    for kind, oids in (('good', good), ('deleted', deleted)):
+        for dbname, data in sorted(oids.items()):
+            for prefix, suffixes in data.items():
+                marshal.dump((kind, dbname, prefix, b''.join(suffixes)), f)
+    for oid, tid, refs in bad.items(name):
+        marshal.dump(('bad', oid, tid, refs), f)
+
+
+def _load_partial_header(f):
+    header = marshal.load(f)
+    if not (isinstance(header, tuple) and header[0] == _partial_magic):
+        raise ValueError("Not a partial result", f.name)
+    return header[1:]
+
+
+def _load_partial(f, good, deleted, bad):
+    header = name, ptid, tid, ignore = _load_partial_header(f)
+    if name not in good:
+        raise ValueError("Unknown database, %r." % name)
+    logger.info("%s: load partial result from %s, ptid %s",
+                name, f.name, TimeStamp.TimeStamp(ptid))
+    oidsets = dict(good=good, deleted=deleted)
+    while 1:
+        try:
+            record = marshal.load(f)
+        except EOFError:
+            break
+        if record[0] == 'bad':
+            _, oid, tid, refs = record
+            bad.insert(name, oid, tid, refs)
+        else:
+            kind, dbname, prefix, suffixes = record
+            oids = oidsets[kind]
+            for i in range(0, len(suffixes), 2):
+                oids.insert(dbname, prefix + suffixes[i:i+2])
+    return header
+
+
+def merge_command(args=None, return_bad=False):
+    # The setuptools entry point for merging partial results and
+    # removing the garbage found.  Arguments and keyword arguments
+    # are for internal use only and may change at any time.
+
+    if args is None:
+        args = sys.argv[1:]
+        level = logging.WARNING
+    else:
+        level = None
+
+    parser = optparse.OptionParser(
+        "usage: %prog [options] config partial1 [partial2 ...]")
+    parser.add_option(
+        '-l', '--log-level', dest='level',
+        help='The logging level. The default is WARNING.')
+
+    options, args = parser.parse_args(args)
+
+    if len(args) < 2:
+        parser.parse_args(['-h'])
+
+    _setup_logging(options, level)
+
+    return merge(args[0], args[1:], return_bad=return_bad)
+
+
+def merge(conf, partials, return_bad=False):
+    # Merge the partial results saved by workers and remove the
+    # garbage. Internal function only, all arguments and return
+    # values may change at any time.
+    close = []
     try:
-        check_(config, references)
+        with open(conf) as f:
+            db = ZODB.config.databaseFromFile(f)
+        close.append(db)
+        databases = db.databases
+
+        # Without a partial result for a database, the references it
+        # makes aren't known, so objects it references could be
+        # removed.
+        names = []
+        for path in partials:
+            with open(path, 'rb') as f:
+                names.append(_load_partial_header(f)[0])
+        duplicates = sorted(set(n for n in names if names.count(n) > 1))
+        if duplicates:
+            raise ValueError("More than one partial result for databases",
+                             duplicates)
+        missing = sorted(set(databases) - set(names))
+        if missing:
+            raise ValueError("No partial results for databases", missing)
+        unknown = sorted(set(names) - set(databases))
+        if unknown:
+            raise ValueError("Partial results for unknown databases",
+                             unknown)
+
+        good = oidset(databases)
+        bad = Bad(databases)
+        close.append(bad)
+        deleted = oidset(databases)
+
+        headers = []
+        for path in partials:
+            with open(path, 'rb') as f:
+                headers.append(_load_partial(f, good, deleted, bad))
+        ptids = set(ptid for (_, ptid, _, _) in headers)
+        if len(ptids) > 1:
+            logger.warning("Partial results were analyzed as of different"
+                           " times, from %s to %s, use --analysis-time to"
+                           " give the workers the same time",
+                           TimeStamp.TimeStamp(min(ptids)),
+                           TimeStamp.TimeStamp(max(ptids)))
+
+        # Candidates referenced from good objects in other databases
+        # aren't garbage, and neither is anything they reference.
+        for ref in [ref for ref in bad.iterator()
+                    if good.has(*ref) or deleted.has(*ref)]:
+            if deleted.has(*ref):
+                bad.remove(*ref)
+            else:
+                _rescue(ref, good, bad)
+
+        # References may have moved between databases after the
+        # workers read them.
+        for name, ptid, tid, ignore in sorted(headers):
+            _revalidate(name, databases[name].storage, tid, good, bad,
+                        ignore)
+
+        _remove_garbage(db, bad)
+
+        if return_bad:
+            return sorted((name, int(u64(oid))) for (name, oid)
+                          in bad.iterator())
+    finally:
+        _close(close)
+
+
+def check(config, refdb=None, blob_threads=0, read_blobs=False, state=None,
+          throttle=None):
+    if refdb is None:
+        return check_(config, blob_threads=blob_threads,
+                      read_blobs=read_blobs, state=state, throttle=throttle)
+
+    # An incremental check updates the references from the last check,
+    # if they were saved by the check that saved the state.  Otherwise,
+    # all objects are checked and the references are rebuilt.
+    incremental = (state is not None and os.path.exists(state)
+                   and os.path.exists(refdb))
+    if incremental:
+        with open(state, 'rb') as f:
+            tids = _load_check_state_header(f)
+        fs = ZODB.FileStorage.FileStorage(refdb)
+        conn = ZODB.connection(fs)
+        if (getattr(conn.root, 'references', None) is None
+                or getattr(conn.root, 'check_state', None) != tids):
+            logger.warning("%s wasn't updated by the check that saved %s,"
+                           " checking all objects", refdb, state)
+            incremental = False
+            conn.close()
+            fs.close()
+    if not incremental:
+        fs = ZODB.FileStorage.FileStorage(refdb, create=True)
+        conn = ZODB.connection(fs)
+        conn.root.references = BTrees.OOBTree.BTree()
+    references = conn.root.references
+    # Until the check finishes, the references may not be complete.
+    conn.root.check_state = None
+    try:
+        check_(config, references, blob_threads, read_blobs, state,
+               full=not incremental, throttle=throttle)
+        # Note the state the references are up to date with, so a later
+        # check can tell if the state was saved without updating them.
+        if state is not None and os.path.exists(state):
+            with open(state, 'rb') as f:
+                conn.root.check_state = _load_check_state_header(f)
     finally:
         transaction.commit()
         conn.close()
@@ -558,6 +1927,33 @@ def _insert_ref(references, rname, roid, name, oid):
     return False
 
 
+def _remove_ref(references, rname, roid, name, oid):
+    # Undo _insert_ref, for a reference that has gone away.
+    by_oid = references.get(name)
+    if not by_oid:
+        return
+    oid = u64(oid)
+    roid = u64(roid)
+    by_rname = by_oid.get(oid)
+    if isinstance(by_rname, dict):
+        referers = by_rname.get(rname)
+    elif rname == name:
+        referers = by_rname
+    else:
+        referers = None
+    if referers is None or roid not in referers:
+        return
+    referers.remove(roid)
+    if referers:
+        return
+    if isinstance(by_rname, dict):
+        del by_rname[rname]
+        if by_rname:
+            by_oid[oid] = by_rname
+            return
+    del by_oid[oid]
+
+
 def _get_referer(references, name, oid):
     if references is None:
         return
@@ -573,18 +1969,114 @@ def _get_referer(references, name, oid):
                 return name, p64(next(iter(by_rname)))
 
 
-def check_(config, references=None):
+def _check_blob(storage, oid, tid, read):
+    filename = storage.loadBlob(oid, tid)
+    if read:
+        with open(filename, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+
+
+def _get_referers(references, name, oid):
+    by_oid = references.get(name)
+    if by_oid:
+        by_rname = by_oid.get(u64(oid))
+        if isinstance(by_rname, dict):
+            for rname, roids in by_rname.items():
+                for roid in roids:
+                    yield rname, p64(roid)
+        elif by_rname:
+            for roid in by_rname:
+                yield name, p64(roid)
+
+
+def _report_error(references, name, oid, t, v, referer=None):
+    print('!!!', name, u64(oid), end=' ')
+
+    if referer is None:
+        referer = _get_referer(references, name, oid)
+    if referer:
+        rname, roid = referer
+        print(rname, u64(roid))
+    else:
+        print('?')
+    print("{}: {}".format(t.__name__, v))
+
+
+def check_(config, references=None, blob_threads=0, read_blobs=False,
+           state=None, full=False, throttle=None):
+    # If state names a file saved by an earlier check, and full is
+    # false, only objects written since then, and objects they
+    # reference that weren't reachable then, are checked.  After a
+    # check without errors, the state is saved.  If a throttle is
+    # given, loading objects is limited by it.
     with open(config) as f:
         db = ZODB.config.databaseFromFile(f)
+    if blob_threads:
+        # Blobs are checked by a pool of threads, with a bounded
+        # number of checks pending.
+        executor = concurrent.futures.ThreadPoolExecutor(blob_threads)
+    else:
+        executor = None
+    pending = {}
+    errors = []
+
+    def report_error(name, oid, t, v):
+        errors.append((name, oid))
+        _report_error(references, name, oid, t, v)
+
+    def blobs_checked(futures):
+        for future in futures:
+            name, oid = pending.pop(future)
+            v = future.exception()
+            if v is not None:
+                report_error(name, oid, v.__class__, v)
+
     try:
         databases = db.databases
         storages = {name: db.storage for (name, db) in databases.items()}
+        tids = {name: storage.lastTransaction()
+                for (name, storage) in storages.items()}
+
+        # Objects reachable at the last check that haven't changed
+        # since don't need to be checked again.
+        verified = oidset(databases)
+        changed = oidset(databases)
+        deleted = oidset(databases)
+        last_tids = {}
+        if state is not None and not full and os.path.exists(state):
+            with open(state, 'rb') as f:
+                last_tids = _load_check_state(f, verified)
+            for name, storage in sorted(storages.items()):
+                _scan_changes(name, storage, last_tids, tids,
+                              verified, changed, deleted)
+
+        # Unchanged objects may reference objects that were reachable
+        # at the last check and have been deleted since.  They can only
+        # be found with the references database.
+        lost = [ref for ref in deleted.iterator() if verified.has(*ref)]
+        if lost and references is None:
+            logger.warning("%s objects reachable at the last check were"
+                           " deleted, checking all objects", len(lost))
+            last_tids.clear()
+            verified = oidset(databases)
+            lost = ()
 
         roots = oidset(databases)
         for name in databases:
-            roots.insert(name, z64)
+            if name not in last_tids:
+                roots.insert(name, z64)
+        for name, oid in changed.iterator():
+            if verified.has(name, oid) and not deleted.has(name, oid):
+                roots.insert(name, oid)
+        for ref in lost:
+            for referer in _get_referers(references, *ref):
+                if not deleted.has(*referer):
+                    roots.insert(*referer)
         seen = oidset(databases)
         nreferences = 0
+        if throttle is not None:
+            since = throttle.snapshot()
 
         while roots:
             name, oid = roots.pop()
@@ -593,27 +2085,39 @@ def check_(config, references=None):
                 if not seen.insert(name, oid):
                     continue
                 p, tid = storages[name].load(oid, b'')
-                if (  # XXX should be in is_blob_record
-                    len(p) < 100 and (b'ZODB.blob' in p)
-                        and ZODB.blob.is_blob_record(p)
-                ):
-                    storages[name].loadBlob(oid, tid)
+                if throttle is not None:
+                    throttle.consume(1, len(p))
+                if executor is None:
+                    _check_if_blob(storages[name], oid, tid, p, read_blobs)
+                elif _is_blob(p):
+                    if len(pending) >= 10 * blob_threads:
+                        blobs_checked(concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED,
+                        ).done)
+                    pending[executor.submit(
+                        _check_blob, storages[name], oid, tid, read_blobs,
+                    )] = name, oid
             except:  # noqa: E722 do not use bare 'except'
-                print('!!!', name, u64(oid), end=' ')
-
-                referer = _get_referer(references, name, oid)
-                if referer:
-                    rname, roid = referer
-                    print(rname, u64(roid))
-                else:
-                    print('?')
                 t, v = sys.exc_info()[:2]
-                print("{}: {}".format(t.__name__, v))
+                report_error(name, oid, t, v)
                 continue
 
-            for ref in getrefs(p, name, ()):
+            refs = list(getrefs(p, name, ()))
+            if (references is not None and changed.has(name, oid)
+                    and verified.has(name, oid)):
+                # The object changed since the last check, so forget the
+                # references it no longer makes.
+                for ref in _old_refs(storages[name], name, oid,
+                                     last_tids[name]):
+                    if ref not in refs:
+                        _remove_ref(references, name, oid, *ref)
+                        nreferences += 1
+
+            for ref in refs:
                 if (ref[0] != name) and not databases[name].xrefs:
                     print('bad xref', ref[0], u64(ref[1]), name, u64(oid))
+                    errors.append(ref)
 
                 nreferences += _insert_ref(references, name, oid, *ref)
 
@@ -624,31 +2128,429 @@ def check_(config, references=None):
                 if ref[0] not in databases:
                     print('!!!', ref[0], u64(ref[1]), name, u64(oid))
                     print('bad db')
+                    errors.append(ref)
                     continue
                 if seen.has(*ref):
                     continue
+                if verified.has(*ref) and not changed.has(*ref):
+                    continue
                 roots.insert(*ref)
+
+        blobs_checked(concurrent.futures.wait(pending).done)
+        logger.debug("Checked %s objects", sum(1 for _ in seen.iterator()))
+        if throttle is not None:
+            throttle.report('check', since)
+
+        if state is not None and not errors:
+            # Databases checked fully save exactly the objects reached.
+            for name in databases:
+                if name not in last_tids:
+                    verified[name].clear()
+            for name, oid in seen.iterator():
+                verified.insert(name, oid)
+            for name, oid in deleted.iterator():
+                verified.remove(name, oid)
+            _save_check_state(state, tids, verified)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for d in db.databases.values():
+            d.close()
+
+
+_check_state_magic = 'zc.zodbdgc check state 1'
+
+
+def _save_check_state(path, tids, verified):
+    # The file has a header with the last transaction id of each
+    # database, followed by the reachable oids, a prefix at a time.
+    # It's written to a temporary file and renamed, so a check that
+    # fails while saving leaves the earlier state.
+    with open(path + '.tmp', 'wb') as f:
+        marshal.dump((_check_state_magic, tids), f)
+        for name, data in sorted(verified.items()):
+            for prefix, suffixes in data.items():
+                marshal.dump((name, prefix, b''.join(suffixes)), f)
+    os.replace(path + '.tmp', path)
+
+
+def _load_check_state_header(f):
+    header = marshal.load(f)
+    if not (isinstance(header, tuple) and header[0] == _check_state_magic):
+        raise ValueError("Not a check state", f.name)
+    return header[1]
+
+
+def _load_check_state(f, verified):
+    tids = {}
+    for name, tid in _load_check_state_header(f).items():
+        if name in verified:
+            tids[name] = tid
+    while 1:
+        try:
+            name, prefix, suffixes = marshal.load(f)
+        except EOFError:
+            break
+        if name in tids:
+            for i in range(0, len(suffixes), 2):
+                verified.insert(name, prefix + suffixes[i:i+2])
+    return tids
+
+
+def _scan_changes(name, storage, last_tids, tids, verified, changed, deleted):
+    # Find the objects written since the last check. If the database
+    # is older than the last check, as after restoring a backup, its
+    # saved state is useless.
+    last_tid = last_tids.get(name)
+    if last_tid is None:
+        return
+    if tids[name] < last_tid:
+        logger.warning("%s: older than the last check, checking all objects",
+                       name)
+        del last_tids[name]
+        verified[name].clear()
+        return
+    if tids[name] == last_tid:
+        return
+    logger.info("%s: objects written since %s", name,
+                TimeStamp.TimeStamp(last_tid))
+    it = storage.iterator(p64(u64(last_tid) + 1), tids[name])
+    try:
+        for trans in it:
+            # Garbage removed by multi-zodb-gc wasn't reachable, so
+            # nothing reachable can refer to it.
+            collected = (getattr(trans, 'description', None)
+                         == _remove_garbage_description)
+            for record in trans:
+                changed.insert(name, record.oid)
+                if record.data:
+                    deleted.remove(name, record.oid)
+                else:
+                    deleted.insert(name, record.oid)
+                    if collected:
+                        verified.remove(name, record.oid)
+    finally:
+        if hasattr(it, 'close'):
+            it.close()
+
+
+def _old_refs(storage, name, oid, last_tid):
+    # The references made by an object as of the last check, if its
+    # state then is still available.
+    try:
+        old = storage.loadBefore(oid, p64(u64(last_tid) + 1))
+    except ZODB.POSException.POSKeyError:
+        return []
+    if not old or not old[0]:
+        return []
+    return list(getrefs(old[0], name, ()))
+
+
+def sample_check(config, size, by_class=False, time_limit=None,
+                 read_blobs=False, seed=None):
+    # Check a random sample of size objects from each database or, if
+    # by_class is true, from each class in each database.  The sampled
+    # objects, and the objects and blobs they reference directly, are
+    # loaded, until time_limit seconds have passed.  For each sample,
+    # the fraction of sampled objects with errors is reported, with an
+    # upper bound at 95% confidence.  Sampling gets at most half of the
+    # time, shared among the databases, so some is left for checking.
+    deadline = None if time_limit is None else time.time() + time_limit
+    rand = random.Random(seed)
+    with open(config) as f:
+        db = ZODB.config.databaseFromFile(f)
+    try:
+        databases = db.databases
+        storages = {name: db.storage for (name, db) in databases.items()}
+
+        samples = {}
+        coverage = {}
+        sampling = sorted(storages.items())
+        for i, (name, storage) in enumerate(sampling):
+            sample_deadline = None
+            if deadline is not None:
+                now = time.time()
+                left = max(deadline - time_limit / 2 - now, 0)
+                sample_deadline = now + left / (len(sampling) - i)
+            sampled, coverage[name] = _sample(
+                name, storage, size, by_class, rand, sample_deadline)
+            for key, oids in sampled:
+                rand.shuffle(oids)
+                samples[key] = oids
+
+        # Check the samples round robin, so they're all represented if
+        # time runs out.
+        results = {key: [0, 0] for key in samples}
+        queues = sorted(samples.items())
+        while queues and (deadline is None or time.time() < deadline):
+            key, oids = queues.pop(0)
+            name = key[0]
+            oid = oids.pop()
+            ok = _check_sampled(databases, storages, name, oid, read_blobs)
+            if ok is not None:
+                results[key][0] += 1
+                if not ok:
+                    results[key][1] += 1
+            if oids:
+                queues.append((key, oids))
+
+        for key, (checked, failed) in sorted(results.items()):
+            if samples[key]:
+                logger.warning("%s: out of time, %s sampled objects not"
+                               " checked", ' '.join(key), len(samples[key]))
+            bound = 'error rate at most %.2f%%' % (
+                _upper_bound(failed, checked) * 100)
+            if coverage[key[0]]:
+                # The bound only applies to the objects sampled from.
+                bound += ', sampled from ' + coverage[key[0]]
+            print(' '.join(key) + ':',
+                  '%s sampled objects checked,' % checked,
+                  '%s with errors,' % failed, bound)
     finally:
         for d in db.databases.values():
             d.close()
 
 
+def _sample(name, storage, size, by_class, rand, deadline):
+    # Choose up to size oids at random from the storage, or from each
+    # class in the storage, with reservoir sampling.  Return a list of
+    # ((name,) or (name, class), oids) pairs, and a description of the
+    # objects sampled from if the deadline passed before all of them
+    # were considered.
+    index = getattr(storage, '_index', None)
+    if isinstance(index, ZODB.fsIndex.fsIndex) and not by_class:
+        oids = list(itertools.islice(_random_oids(index, rand), size))
+        return [((name, ), oids)], None
+    reservoirs = {} if by_class else {(name, ): [0, []]}
+    coverage = []
+    for oid, class_name in _iter_current(storage, by_class, rand, deadline,
+                                         coverage):
+        if by_class:
+            if not class_name:
+                continue
+            key = name, class_name
+        else:
+            key = (name, )
+        reservoir = reservoirs.get(key)
+        if reservoir is None:
+            reservoir = reservoirs[key] = [0, []]
+        reservoir[0] += 1
+        seen, oids = reservoir
+        if len(oids) < size:
+            oids.append(oid)
+        else:
+            i = rand.randrange(seen)
+            if i < size:
+                oids[i] = oid
+    if coverage:
+        logger.warning("%s: out of time, sampled from %s", name, coverage[0])
+    return ([(key, oids) for (key, (seen, oids))
+             in sorted(reservoirs.items())],
+            coverage[0] if coverage else None)
+
+
+def _iter_current(storage, with_class, rand, deadline=None, coverage=None):
+    # Iterate over the oids, with their current class names if wanted,
+    # of the objects in a storage.  With a file-storage index, and a
+    # deadline, the objects are visited in random order, so the ones
+    # visited before the deadline are a random sample.  Otherwise,
+    # all transactions are read, until the deadline.  Deleted objects
+    # may be included if class names aren't wanted.  If the deadline
+    # passes, a description of the objects visited is appended to
+    # coverage.
+    index = getattr(storage, '_index', None)
+    if isinstance(index, ZODB.fsIndex.fsIndex):
+        oids = index.keys() if deadline is None else _random_oids(index, rand)
+        n = 0
+        for oid in oids:
+            if deadline is not None and time.time() > deadline:
+                if coverage is not None:
+                    coverage.append("a random %s of %s objects"
+                                    % (n, len(index)))
+                break
+            n += 1
+            if with_class:
+                try:
+                    data = storage.load(oid, b'')[0]
+                except ZODB.POSException.POSKeyError:
+                    continue
+                yield oid, _class_name(data)
+            else:
+                yield oid, None
+    else:
+        current = {}
+        it = storage.iterator()
+        try:
+            n = 0
+            for trans in it:
+                if deadline is not None and time.time() > deadline:
+                    if coverage is not None:
+                        coverage.append("objects written in the first %s"
+                                        " transactions" % n)
+                    break
+                n += 1
+                for record in trans:
+                    if record.data:
+                        current[record.oid] = (
+                            _class_name(record.data) if with_class else None)
+                    else:
+                        current.pop(record.oid, None)
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+        for oid, class_name in current.items():
+            yield oid, class_name
+
+
+def _random_oids(index, rand):
+    # Generate the oids in a file-storage index in random order,
+    # without repeats.  A bucket of oids sharing a prefix is chosen with
+    # probability proportional to its size, and then an oid in it.
+    buckets = []
+    ends = []
+    n = 0
+    for prefix, bucket in index._data.items():
+        n += len(bucket)
+        buckets.append((prefix, bucket))
+        ends.append(n)
+    seen = set()
+    while len(seen) < n:
+        prefix, bucket = buckets[bisect.bisect_right(ends, rand.randrange(n))]
+        oid = prefix + _random_suffix(bucket, rand)
+        if oid not in seen:
+            seen.add(oid)
+            yield oid
+
+
+def _random_suffix(bucket, rand):
+    # Choose a key at random from a bucket of oid suffixes, by choosing
+    # from the range of keys until one is in the bucket, if enough of
+    # the range is, as listing the keys is slow.
+    low, = struct.unpack('>H', bucket.minKey())
+    high, = struct.unpack('>H', bucket.maxKey())
+    if high - low + 1 > 64 * len(bucket):
+        return rand.choice(bucket.keys())
+    while True:
+        suffix = struct.pack('>H', rand.randint(low, high))
+        if suffix in bucket:
+            return suffix
+
+
+def _class_name(data):
+    # Many objects share a class, so share the name.
+    return sys.intern('.'.join(ZODB.utils.get_pickle_metadata(data)))
+
+
+def _check_sampled(databases, storages, name, oid, read_blobs):
+    # Check that a sampled object, and the objects it references, can
+    # be loaded, reporting errors.  Return whether there were none, or
+    # None if the object has been deleted.
+    try:
+        p, tid = storages[name].load(oid, b'')
+    except ZODB.POSException.POSKeyError:
+        return None
+    try:
+        _check_if_blob(storages[name], oid, tid, p, read_blobs)
+    except Exception:
+        t, v = sys.exc_info()[:2]
+        _report_error(None, name, oid, t, v)
+        return False
+    ok = True
+    for ref in getrefs(p, name, ()):
+        if (ref[0] != name) and not databases[name].xrefs:
+            print('bad xref', ref[0], u64(ref[1]), name, u64(oid))
+            ok = False
+        if ref[0] not in databases:
+            print('!!!', ref[0], u64(ref[1]), name, u64(oid))
+            print('bad db')
+            ok = False
+            continue
+        try:
+            _load_checked(storages[ref[0]], ref[1], read_blobs)
+        except Exception:
+            t, v = sys.exc_info()[:2]
+            _report_error(None, ref[0], ref[1], t, v, (name, oid))
+            ok = False
+    return ok
+
+
+def _load_checked(storage, oid, read_blobs):
+    p, tid = storage.load(oid, b'')
+    _check_if_blob(storage, oid, tid, p, read_blobs)
+
+
+def _check_if_blob(storage, oid, tid, p, read_blobs):
+    if _is_blob(p):
+        _check_blob(storage, oid, tid, read_blobs)
+
+
+def _is_blob(p):
+    # XXX should be in is_blob_record
+    return (len(p) < 100 and (b'ZODB.blob' in p)
+            and ZODB.blob.is_blob_record(p))
+
+
+def _upper_bound(failed, checked, z=1.96):
+    # The upper bound of the Wilson score interval for a proportion,
+    # at 95% confidence by default.
+    if not checked:
+        return 1.0
+    p = failed / checked
+    z2 = z * z
+    return min(1.0, (p + z2 / (2 * checked) + z * math.sqrt(
+        p * (1 - p) / checked + z2 / (4 * checked * checked)))
+        / (1 + z2 / checked))
+
+
 def check_command(args=None):
     if args is None:
         args = sys.argv[1:]
         logging.basicConfig(level=logging.WARNING, format=log_format)
 
     parser = optparse.OptionParser("usage: %prog [options] config")
+    parser.add_option(
+        '-b', '--blob-threads', dest='blob_threads', type='int', default=0,
+        help='Number of threads used to check blob files. The default, 0,'
+        ' checks blob files as they are found.')
+    parser.add_option(
+        '-B', '--read-blobs', dest='read_blobs', action='store_true',
+        help='Read blob files fully, rather than just checking that'
+        ' they exist.')
     parser.add_option(
         '-r', '--references-filestorage', dest='refdb',
         help='The name of a file-storage to save reference info in.')
+    parser.add_option(
+        '-s', '--state', dest='state',
+        help='The name of a file to save the state of a check without'
+        ' errors in. If the file exists, only objects written since the'
+        ' saved check, and objects newly reachable from them, are'
+        ' checked.')
+    parser.add_option(
+        '-n', '--sample', dest='sample', type='int',
+        help='Check a random sample of this many objects from each'
+        ' database, and the objects they reference, rather than all'
+        ' reachable objects, and estimate the rate of errors.')
+    parser.add_option(
+        '-c', '--by-class', dest='by_class', action='store_true',
+        help='With --sample, sample objects from each class, rather'
+        ' than from each database.')
+    parser.add_option(
+        '-t', '--time-limit', dest='time_limit', type='float',
+        help='With --sample, the number of seconds to spend sampling and'
+        ' checking.')
+    _add_throttle_options(parser)
 
     options, args = parser.parse_args(args)
 
     if not args or len(args) > 1:
         parser.parse_args(['-h'])
 
-    check(args[0], options.refdb)
+    if options.sample:
+        sample_check(args[0], options.sample, options.by_class,
+                     options.time_limit, options.read_blobs)
+    else:
+        check(args[0], options.refdb, options.blob_threads,
+              options.read_blobs, options.state, _throttle(options))
 
 
 class References:
@@ -13,6 +13,7 @@
 ##############################################################################
 import binascii
 import doctest
+import os
 import re
 import unittest
 from unittest import mock
@@ -24,6 +25,12 @@ from zope.testing import setupstack
 import zc.zodbdgc
 
 
+try:
+    import relstorage
+except ImportError:
+    relstorage = None
+
+
 def untransform(data):
     if data[:2] == b'.h':
         data = binascii.a2b_hex(data[2:])
@@ -200,6 +207,1547 @@ def test_missmatched_configs():
     """
 
 
+def test_distributed():
+    """
+Databases can be analyzed separately by workers, typically running on
+the machines that hold the storages, and the partial results merged
+to find the garbage.
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db1>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 2.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+
+    >>> import persistent.mapping, shutil, transaction
+    >>> C = persistent.mapping.PersistentMapping
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn1 = db.open()
+    >>> conn2 = conn1.get_connection('db2')
+
+An object in db2 that's only referenced from db1 is good:
+
+    >>> conn1.root.a = C()
+    >>> conn1.root.a.x = C()
+    >>> conn2.add(conn1.root.a.x)
+
+A garbage object in db2 referencing an object in db1 that's
+otherwise unreferenced makes both garbage, as does a garbage object in
+db1 referencing an object in db2:
+
+    >>> conn2.root.y = C()
+    >>> conn2.root.y.z = C()
+    >>> conn1.add(conn2.root.y.z)
+    >>> conn1.root.w = C()
+    >>> conn1.root.w.v = C()
+    >>> conn2.add(conn1.root.w.v)
+    >>> transaction.commit()
+    >>> del conn2.root.y, conn1.root.w
+    >>> transaction.commit()
+
+Pack away the old revisions still referencing the garbage, and note the
+analysis time:
+
+    >>> from ZODB.utils import p64, u64
+    >>> ptid = p64(u64(db.lastTransaction()) + 1)
+    >>> _ = [d.pack() for d in db.databases.values()]
+    >>> _ = [d.close() for d in db.databases.values()]
+
+    >>> for name in '12':
+    ...     _ = shutil.copyfile(name + '.fs', name + '.fs-save')
+
+The workers run as separate processes, each producing a partial
+result:
+
+    >>> import subprocess, sys
+    >>> workers = [
+    ...     subprocess.Popen([
+    ...         sys.executable, '-c',
+    ...         'import sys, zc.zodbdgc; '
+    ...         'zc.zodbdgc.worker_command(sys.argv[2:], '
+    ...         'bytes.fromhex(sys.argv[1]))',
+    ...         ptid.hex(), '-d0', 'config', name, name + '.partial'])
+    ...     for name in ('db1', 'db2')]
+    >>> [worker.wait() for worker in workers]
+    [0, 0]
+
+    >>> zc.zodbdgc.merge_command(
+    ...     ['config', 'db1.partial', 'db2.partial'], return_bad=True)
+    [('db1', 1), ('db1', 3), ('db2', 2), ('db2', 3)]
+
+There must be exactly one partial result for each database.  Otherwise,
+objects referenced only from a database without one could be removed:
+
+    >>> zc.zodbdgc.merge_command(['config', 'db1.partial'])
+    Traceback (most recent call last):
+    ...
+    ValueError: ('No partial results for databases', ['db2'])
+    >>> zc.zodbdgc.merge_command(
+    ...     ['config', 'db1.partial', 'db2.partial', 'db1.partial'])
+    Traceback (most recent call last):
+    ...
+    ValueError: ('More than one partial result for databases', ['db1'])
+
+A warning is logged if the partial results were analyzed as of
+different times:
+
+    >>> import logging
+    >>> from zope.testing.loggingsupport import InstalledHandler
+    >>> handler = InstalledHandler('zc.zodbdgc', level=logging.WARNING)
+    >>> zc.zodbdgc.worker('config', 'db2', 'db2-later.partial',
+    ...                   ptid=p64(u64(ptid) + 1))
+    >>> zc.zodbdgc.merge_command(
+    ...     ['config', 'db1.partial', 'db2-later.partial'])
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc WARNING
+      Partial results were analyzed as of different times, from ... to ...
+    >>> handler.uninstall()
+
+We get the same result analyzing all of the databases at once:
+
+    >>> for name in '12':
+    ...     _ = shutil.copyfile(name + '.fs-save', name + '.fs')
+    ...     os.remove(name + '.fs.index')
+    >>> zc.zodbdgc.gc('config', days=0, ptid=ptid, return_bad=True)
+    [('db1', 1), ('db1', 3), ('db2', 2), ('db2', 3)]
+
+Workers only open the database they analyze:
+
+    >>> os.remove('1.fs')
+    >>> zc.zodbdgc.worker('config', 'db2', 'db2.partial')
+    >>> os.path.exists('1.fs')
+    False
+
+    >>> zc.zodbdgc.worker('config', 'db3', 'db3.partial')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown database, 'db3'.
+    """
+
+
+def test_distributed_revalidate():
+    """
+Workers save the last transaction they read, and merging reads the
+transactions committed since, so references moved between databases
+after a worker finished aren't missed:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db1>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 2.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import logging, persistent.mapping, transaction
+    >>> from ZODB.utils import p64, u64
+    >>> from zope.testing.loggingsupport import InstalledHandler
+    >>> def opendb():
+    ...     with open('config') as f:
+    ...         db = ZODB.config.databaseFromFile(f)
+    ...     conn1 = db.open()
+    ...     return db, conn1, conn1.get_connection('db2')
+    >>> db, conn1, conn2 = opendb()
+    >>> conn2.root.b = persistent.mapping.PersistentMapping()
+    >>> transaction.commit()
+    >>> ptid = p64(u64(db.lastTransaction()) + 1)
+    >>> _ = [d.close() for d in db.databases.values()]
+    >>> zc.zodbdgc.worker('config', 'db1', 'db1.partial', days=0, ptid=ptid)
+
+The object is moved from db2 to db1 before db2's worker runs, with a
+later analysis time:
+
+    >>> db, conn1, conn2 = opendb()
+    >>> conn1.root.a = conn2.root.b
+    >>> del conn2.root.b
+    >>> transaction.commit()
+    >>> db.databases['db2'].pack()
+    >>> ptid = p64(u64(db.lastTransaction()) + 1)
+    >>> _ = [d.close() for d in db.databases.values()]
+    >>> zc.zodbdgc.worker('config', 'db2', 'db2.partial', days=0, ptid=ptid)
+
+    >>> handler = InstalledHandler('zc.zodbdgc', level=logging.INFO)
+    >>> zc.zodbdgc.merge_command(
+    ...     ['config', 'db1.partial', 'db2.partial'], return_bad=True)
+    []
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db1: load partial result from db1.partial, ptid ...
+    zc.zodbdgc INFO
+      db2: load partial result from db2.partial, ptid ...
+    zc.zodbdgc WARNING
+      Partial results were analyzed as of different times, ...
+    zc.zodbdgc INFO
+      db1: kept 0 garbage objects written and 1 referenced since ...
+    ...
+    >>> handler.uninstall()
+
+The workers can be given the same analysis time with the
+--analysis-time/-T option:
+
+    >>> zc.zodbdgc.worker_command(
+    ...     ['-T', '2024-01-31T12:00:00', 'config', 'db1', 'db1.partial'])
+    >>> with open('db1.partial', 'rb') as f:
+    ...     print(persistent.TimeStamp.TimeStamp(
+    ...         zc.zodbdgc._load_partial_header(f)[1]))
+    2024-01-31 12:00:00.000000
+    >>> zc.zodbdgc.worker_command(
+    ...     ['-T', 'yesterday', 'config', 'db1', 'db1.partial'])
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    SystemExit: 2
+    """
+
+
+def test_read_ahead():
+    """
+When iterating over storages, rather than files, transactions can be
+read ahead in a background thread:
+
+    >>> class Trans(list):
+    ...     tid = None
+    >>> transactions = []
+    >>> for i in range(5):
+    ...     trans = Trans(range(i))
+    ...     trans.tid = i
+    ...     transactions.append(trans)
+
+    >>> it = zc.zodbdgc.ReadAhead(iter(transactions), 2, 'db')
+    >>> [(trans.tid, list(trans)) for trans in it]
+    [(0, []), (1, [0]), (2, [0, 1]), (3, [0, 1, 2]), (4, [0, 1, 2, 3])]
+    >>> list(it)
+    []
+
+Stall counts show whether the producer or the consumer had to wait:
+
+    >>> it.producer_stalls >= 0, it.consumer_stalls >= 0
+    (True, True)
+    >>> it.close()
+
+Errors raised iterating are raised to the consumer:
+
+    >>> def broken():
+    ...     yield transactions[0]
+    ...     raise ValueError('broken')
+    >>> it = zc.zodbdgc.ReadAhead(broken(), 2)
+    >>> len(list(next(it)))
+    0
+    >>> next(it)
+    Traceback (most recent call last):
+    ...
+    ValueError: broken
+    >>> it.close()
+
+The consumer can stop early. Closing stops the reader thread even if
+it's waiting for room in the queue:
+
+    >>> it = zc.zodbdgc.ReadAhead(iter(transactions), 1)
+    >>> next(it).tid
+    0
+    >>> it.close()
+    >>> it._thread.is_alive()
+    False
+
+Reading ahead is used with the --read-ahead/-a option:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> for i in range(9):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    ...     conn.transaction_manager.commit()
+    >>> for i in range(3):
+    ...     del conn.root()[i]
+    ...     conn.transaction_manager.commit()
+    >>> db.pack()
+    >>> ptid = conn.root()._p_serial
+    >>> db.close()
+
+    >>> zc.zodbdgc.gc_command(['-a3', 'config'], ptid, return_bad=True)
+    [('', 1), ('', 2), ('', 3)]
+    """
+
+
+def test_current_only():
+    """
+Normally, all of the revisions of old records are read and objects
+referenced by any revision of a good object are good.  With the
+--current-only/-c option, only the current revisions of objects in
+files given with -f are read, using the file-storage index.
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, shutil
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> for i in range(6):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    ...     conn.transaction_manager.commit()
+    >>> db.close()
+
+We'll save the index now, to use it later as if it was out of date:
+
+    >>> _ = shutil.copyfile('1.fs.index', 'old.index')
+
+Remove some objects from the root. Old revisions of the root still
+reference them:
+
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> del conn.root()[0], conn.root()[1]
+    >>> conn.transaction_manager.commit()
+    >>> ptid = conn.root()._p_serial
+
+Objects removed after the analysis time are referenced by the
+revision of the root current as of then, so they aren't garbage:
+
+    >>> del conn.root()[2]
+    >>> conn.transaction_manager.commit()
+    >>> db.close()
+
+    >>> _ = shutil.copyfile('1.fs', 'a.fs')
+    >>> _ = shutil.copyfile('1.fs.index', 'a.fs.index')
+
+    >>> zc.zodbdgc.gc_command(['-f=a.fs', 'config'], ptid, return_bad=True)
+    []
+
+    >>> zc.zodbdgc.gc_command(['-c', '-f=a.fs', 'config'], ptid,
+    ...                       return_bad=True)
+    [('', 1), ('', 2)]
+
+Records written after the index was saved are taken into account.
+Here, the revision of the root current as of the analysis time was
+written after the old index was saved.  The other objects were each
+written once, in the same transactions as earlier revisions of the
+root:
+
+    >>> _ = shutil.copyfile('old.index', 'a.fs.index')
+    >>> from ZODB.utils import u64
+    >>> it = zc.zodbdgc.CurrentIterator('a.fs', ptid)
+    >>> [[u64(r.oid) for r in t] for t in it]
+    [[1], [2], [3], [4], [5], [6], [0]]
+    >>> it.close()
+
+An index that doesn't match the file, as when it was saved before the
+file was packed, isn't used:
+
+    >>> import persistent.TimeStamp, ZODB.serialize
+    >>> _ = shutil.copyfile('a.fs.index', 'packed.index')
+    >>> fs = ZODB.FileStorage.FileStorage('a.fs', pack_gc=False)
+    >>> fs.pack(persistent.TimeStamp.TimeStamp(ptid).timeTime(),
+    ...         ZODB.serialize.referencesf)
+    >>> fs.close()
+    >>> _ = shutil.copyfile('packed.index', 'a.fs.index')
+    >>> zc.zodbdgc.CurrentIterator('a.fs', ptid)
+    Traceback (most recent call last):
+    ...
+    ValueError: ("The index doesn't match the file", 'a.fs')
+
+All revisions are read instead:
+
+    >>> import logging
+    >>> from zope.testing.loggingsupport import InstalledHandler
+    >>> handler = InstalledHandler('zc.zodbdgc', level=logging.WARNING)
+    >>> zc.zodbdgc.gc('config', fs={'': 'a.fs'}, ptid=ptid, current=True,
+    ...               return_bad=True)
+    []
+    >>> print(handler)
+    zc.zodbdgc WARNING
+      : a.fs.index doesn't match a.fs, reading all revisions
+    >>> handler.uninstall()
+
+If there's no index, all revisions are read:
+
+    >>> os.remove('a.fs.index')
+    >>> zc.zodbdgc.gc('config', fs={'': 'a.fs'}, ptid=ptid, current=True,
+    ...               return_bad=True)
+    []
+    """
+
+
+def test_check_blobs_in_threads():
+    """
+Blob files can be checked by a pool of threads, using the
+--blob-threads/-b option of multi-zodb-check-refs:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db>
+    ...     <filestorage>
+    ...         path 1.fs
+    ...         blob-dir blobs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import transaction, ZODB.blob
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i] = ZODB.blob.Blob(b'data %d' % i)
+    >>> transaction.commit()
+    >>> os.remove(conn.root()[7].committed())
+    >>> db.close()
+
+    >>> zc.zodbdgc.check_command(['-b2', 'config']) # doctest: +ELLIPSIS
+    !!! db 8 ?
+    POSKeyError: ...No blob file at ...
+
+Blob files are read fully with the --read-blobs/-B option:
+
+    >>> zc.zodbdgc.check_command(['-b2', '-B', 'config'])
+    ... # doctest: +ELLIPSIS
+    !!! db 8 ?
+    POSKeyError: ...No blob file at ...
+
+    >>> zc.zodbdgc.check_command(['-B', 'config']) # doctest: +ELLIPSIS
+    !!! db 8 ?
+    POSKeyError: ...No blob file at ...
+    """
+
+
+def test_pack():
+    """
+With the --pack/-p option, file storages are packed to the analysis
+time, leaving out the garbage, rather than having delete records
+written:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...         blob-dir blobs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, ZODB.blob
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> for i in range(6):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    ...     conn.transaction_manager.commit()
+    >>> conn.root()[0].blob = ZODB.blob.Blob(b'data')
+    >>> conn.root()[1].x = conn.root()[2]
+    >>> conn.transaction_manager.commit()
+    >>> blob_path = conn.root()[0].blob.committed()
+    >>> written_later = conn.root()[2]
+    >>> del conn.root()[0], conn.root()[1], conn.root()[2]
+    >>> conn.transaction_manager.commit()
+    >>> db.pack()
+    >>> conn.root()[5].x = 1
+    >>> conn.transaction_manager.commit()
+    >>> ptid = conn.root()[5]._p_serial
+
+Objects written after the analysis time are kept, even if they
+were garbage when the analysis was done:
+
+    >>> written_later.x = 1
+    >>> conn.transaction_manager.commit()
+    >>> last = db.lastTransaction()
+    >>> len(db.storage)
+    8
+    >>> db.close()
+
+    >>> from zope.testing.loggingsupport import InstalledHandler
+    >>> handler = InstalledHandler('zc.zodbdgc')
+    >>> zc.zodbdgc.gc_command(['-p', '-d0', 'config'], ptid, return_bad=True)
+    [('db', 1), ('db', 2), ('db', 7)]
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db: roots
+    zc.zodbdgc INFO
+      db: kept 1 garbage objects written and 0 referenced since ...
+    zc.zodbdgc INFO
+      db: remove garbage
+    zc.zodbdgc INFO
+      Removed 3 objects from db
+    >>> handler.uninstall()
+
+The garbage is gone, including the blob file, without any new
+transactions:
+
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> len(db.storage)
+    5
+    >>> db.lastTransaction() == last
+    True
+    >>> os.path.exists(blob_path)
+    False
+    >>> db.close()
+    >>> zc.zodbdgc.check('config')
+    """
+
+
+def test_incremental_check():
+    """
+With the --state/-s option, the state of a check without errors is
+saved, and later checks only load objects written since then, and
+objects newly reachable from them:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db1>
+    ...     <filestorage>
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <filestorage>
+    ...         path 2.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, shutil, transaction, ZODB.utils
+    >>> def opendb():
+    ...     with open('config') as f:
+    ...         db = ZODB.config.databaseFromFile(f)
+    ...     conn = db.open()
+    ...     return conn, conn.get_connection('db2')
+    >>> def close(conn):
+    ...     transaction.commit()
+    ...     _ = [d.close() for d in conn.db().databases.values()]
+    >>> conn, conn2 = opendb()
+    >>> for i in range(5):
+    ...     conn2.root()[i] = persistent.mapping.PersistentMapping()
+    ...     transaction.commit()
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping(
+    ...         x=conn2.root()[i])
+    ...     transaction.commit()
+    >>> close(conn)
+
+    >>> from zope.testing.loggingsupport import InstalledHandler
+    >>> handler = InstalledHandler('zc.zodbdgc')
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> print(handler)
+    zc.zodbdgc DEBUG
+      Checked 12 objects
+    >>> handler.clear()
+    >>> _ = shutil.copyfile('1.fs', 'backup1.fs')
+    >>> _ = shutil.copyfile('2.fs', 'backup2.fs')
+
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> print(handler)
+    zc.zodbdgc DEBUG
+      Checked 0 objects
+    >>> handler.clear()
+
+    >>> conn, conn2 = opendb()
+    >>> conn.root()[1]['y'] = persistent.mapping.PersistentMapping()
+    >>> close(conn)
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db1: objects written since ...
+    zc.zodbdgc DEBUG
+      Checked 2 objects
+    >>> handler.clear()
+
+Errors are found, and the state isn't saved:
+
+    >>> def delete(name, oid):
+    ...     conn, conn2 = opendb()
+    ...     storage = conn.db().databases[name].storage
+    ...     txn = ZODB.Connection.TransactionMetaData()
+    ...     storage.tpc_begin(txn)
+    ...     storage.deleteObject(oid, storage.load(oid)[1], txn)
+    ...     _ = storage.tpc_vote(txn)
+    ...     _ = storage.tpc_finish(txn)
+    ...     close(conn)
+    >>> with open('state', 'rb') as f:
+    ...     saved = f.read()
+    >>> conn, conn2 = opendb()
+    >>> conn.root()[2]['z'] = persistent.mapping.PersistentMapping()
+    >>> transaction.commit()
+    >>> oid = conn.root()[2]['z']._p_oid
+    >>> close(conn)
+    >>> delete('db1', oid)
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    ... # doctest: +ELLIPSIS
+    !!! db1 7 ?
+    POSKeyError: ...
+    >>> with open('state', 'rb') as f:
+    ...     f.read() == saved
+    True
+
+    >>> conn, conn2 = opendb()
+    >>> del conn.root()[2]['z']
+    >>> close(conn)
+    >>> handler.clear()
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db1: objects written since ...
+    zc.zodbdgc DEBUG
+      Checked 1 objects
+    >>> handler.clear()
+
+Deleting objects that were reachable may leave unchanged objects
+referring to them.  Without a references database, these can't be
+found, so all objects are checked:
+
+    >>> delete('db2', ZODB.utils.p64(4))
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    ... # doctest: +ELLIPSIS
+    !!! db2 4 ?
+    POSKeyError: ...
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db2: objects written since ...
+    zc.zodbdgc WARNING
+      1 objects reachable at the last check were deleted, ...
+    zc.zodbdgc DEBUG
+      Checked 13 objects
+    >>> handler.clear()
+
+With a references database, only the objects that referred to them
+are checked again.  A references database is created by a full check:
+
+    >>> conn, conn2 = opendb()
+    >>> del conn.root()[3]['x'], conn2.root()[3]
+    >>> close(conn)
+    >>> zc.zodbdgc.check_command(['-s', 'state', '-r', 'refs.fs', 'config'])
+    >>> delete('db2', ZODB.utils.p64(5))
+    >>> handler.clear()
+    >>> zc.zodbdgc.check_command(['-s', 'state', '-r', 'refs.fs', 'config'])
+    ... # doctest: +ELLIPSIS
+    !!! db2 5 db...
+    POSKeyError: ...
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db2: objects written since ...
+    zc.zodbdgc DEBUG
+      Checked 3 objects
+    >>> handler.clear()
+
+The references database is kept up to date:
+
+    >>> conn, conn2 = opendb()
+    >>> del conn.root()[4]['x'], conn2.root()[4]
+    >>> close(conn)
+    >>> zc.zodbdgc.check_command(['-s', 'state', '-r', 'refs.fs', 'config'])
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db1: objects written since ...
+    zc.zodbdgc INFO
+      db2: objects written since ...
+    zc.zodbdgc DEBUG
+      Checked 2 objects
+    >>> handler.clear()
+    >>> refs = zc.zodbdgc.References('refs.fs')
+    >>> sorted(refs._refs['db2'])
+    [1, 2, 3]
+    >>> sorted(refs['db2', 3])
+    [('db1', 3), ('db2', 0)]
+    >>> transaction.abort()
+    >>> refs.close()
+
+If the state was saved by a check without the references database,
+the references database is out of date, so all objects are checked
+and the references database is rebuilt:
+
+    >>> conn, conn2 = opendb()
+    >>> conn.root()[0]['w'] = persistent.mapping.PersistentMapping()
+    >>> transaction.commit()
+    >>> oid = conn.root()[0]['w']._p_oid
+    >>> close(conn)
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> delete('db1', oid)
+    >>> handler.clear()
+    >>> zc.zodbdgc.check_command(['-s', 'state', '-r', 'refs.fs', 'config'])
+    ... # doctest: +ELLIPSIS
+    !!! db1 8 db1 1
+    POSKeyError: ...
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc WARNING
+      refs.fs wasn't updated by the check that saved state, checking ...
+    zc.zodbdgc DEBUG
+      Checked 12 objects
+    >>> handler.clear()
+
+    >>> conn, conn2 = opendb()
+    >>> del conn.root()[0]['w']
+    >>> close(conn)
+    >>> zc.zodbdgc.check_command(['-s', 'state', '-r', 'refs.fs', 'config'])
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db1: objects written since ...
+    zc.zodbdgc DEBUG
+      Checked 1 objects
+    >>> handler.clear()
+
+Objects removed by multi-zodb-gc weren't reachable, so removing them
+doesn't make the next check a full one:
+
+    >>> import time, ZODB.serialize
+    >>> conn, conn2 = opendb()
+    >>> conn.root()[1]['g'] = persistent.mapping.PersistentMapping()
+    >>> close(conn)
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> conn, conn2 = opendb()
+    >>> del conn.root()[1]['g']
+    >>> close(conn)
+    >>> for path in ('1.fs', '2.fs'):
+    ...     fs = ZODB.FileStorage.FileStorage(path, pack_gc=False)
+    ...     fs.pack(time.time(), ZODB.serialize.referencesf)
+    ...     fs.close()
+    >>> conn, conn2 = opendb()
+    >>> ptid = ZODB.utils.p64(ZODB.utils.u64(conn.db().lastTransaction()) + 1)
+    >>> close(conn)
+    >>> zc.zodbdgc.gc_command(['config'], ptid, return_bad=True)
+    [('db1', 9)]
+    >>> handler.clear()
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      db1: objects written since ...
+    zc.zodbdgc DEBUG
+      Checked 1 objects
+    >>> handler.clear()
+
+If a database is older than the last check, as after restoring a
+backup, all of its objects are checked:
+
+    >>> _ = shutil.copyfile('backup1.fs', '1.fs')
+    >>> _ = shutil.copyfile('backup2.fs', '2.fs')
+    >>> zc.zodbdgc.check_command(['-s', 'state', 'config'])
+    >>> print(handler)
+    zc.zodbdgc WARNING
+      db1: older than the last check, checking all objects
+    zc.zodbdgc WARNING
+      db2: older than the last check, checking all objects
+    zc.zodbdgc DEBUG
+      Checked 12 objects
+    >>> handler.uninstall()
+    """
+
+
+def test_sampled_check():
+    """
+With the --sample/-n option, a random sample of objects is checked,
+along with the objects and blobs they reference, and the rate of
+errors is estimated:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db1>
+    ...     <filestorage>
+    ...         path 1.fs
+    ...         blob-dir blobs
+    ...     </filestorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <filestorage>
+    ...         path 2.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, transaction, ZODB.blob
+    >>> def opendb():
+    ...     with open('config') as f:
+    ...         db = ZODB.config.databaseFromFile(f)
+    ...     conn = db.open()
+    ...     return conn, conn.get_connection('db2')
+    >>> def close(conn):
+    ...     transaction.commit()
+    ...     _ = [d.close() for d in conn.db().databases.values()]
+    >>> conn, conn2 = opendb()
+    >>> for i in range(20):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    ...     transaction.commit()
+    >>> conn2.root()['x'] = persistent.mapping.PersistentMapping()
+    >>> transaction.commit()
+    >>> conn.root()[0]['blob'] = ZODB.blob.Blob(b'data')
+    >>> conn.root()[1]['x'] = conn2.root()['x']
+    >>> close(conn)
+
+    >>> zc.zodbdgc.check_command(['-n', '10', 'config'])
+    db1: 10 sampled objects checked, 0 with errors, error rate at most 27.75%
+    db2: 2 sampled objects checked, 0 with errors, error rate at most 65.76%
+
+The sample size is per database, or, with the --by-class/-c option,
+per class:
+
+    >>> zc.zodbdgc.check_command(['-n', '10', '-c', 'config'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    db1 ZODB.blob.Blob: 1 sampled objects checked, 0 with errors,
+        error rate at most 79.35%
+    db1 persistent.mapping.PersistentMapping: 10 sampled objects checked,
+        0 with errors, error rate at most 27.75%
+    db2 persistent.mapping.PersistentMapping: 2 sampled objects checked,
+        0 with errors, error rate at most 65.76%
+
+Missing objects, in the same or other databases, and blobs are
+reported:
+
+    >>> conn, conn2 = opendb()
+    >>> blob_path = conn.root()[0]['blob'].committed()
+    >>> os.remove(blob_path)
+    >>> del conn2.root()['x']
+    >>> close(conn)
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage('2.fs'))
+    >>> db.pack()
+    >>> db.close()
+
+    >>> zc.zodbdgc.sample_check('config', 30, seed=0)
+    ... # doctest: +ELLIPSIS
+    !!! db1 21 db1 1
+    POSKeyError: ...No blob file...
+    !!! db2 1 db1 2
+    POSKeyError: 0x01
+    !!! db1 21 ?
+    POSKeyError: ...No blob file...
+    db1: 22 sampled objects checked, 3 with errors, error rate at most 33.34%
+    db2: 1 sampled objects checked, 0 with errors, error rate at most 79.35%
+
+With a file-storage index, objects are chosen at random from the
+whole index, so a sample isn't biased toward older objects:
+
+    >>> import random, ZODB.fsIndex
+    >>> from ZODB.utils import p64
+    >>> index = ZODB.fsIndex.fsIndex()
+    >>> for i in list(range(20000)) + list(range(1<<20, (1<<20) + 300, 7)):
+    ...     index[p64(i)] = i
+    >>> oids = list(zc.zodbdgc._random_oids(index, random.Random(0)))
+    >>> sorted(oids) == list(index.keys())
+    True
+    >>> oids[:1000] == sorted(oids[:1000])
+    False
+
+With the --time-limit/-t option, checking stops when time runs out:
+
+    >>> from zope.testing.loggingsupport import InstalledHandler
+    >>> handler = InstalledHandler('zc.zodbdgc')
+    >>> zc.zodbdgc.check_command(['-n', '10', '-t', '0', 'config'])
+    db1: 0 sampled objects checked, 0 with errors, error rate at most 100.00%
+    db2: 0 sampled objects checked, 0 with errors, error rate at most 100.00%
+    >>> print(handler)
+    zc.zodbdgc WARNING
+      db1: out of time, 10 sampled objects not checked
+    zc.zodbdgc WARNING
+      db2: out of time, 1 sampled objects not checked
+    >>> handler.clear()
+
+Sampling gets at most half of the time, shared among the databases,
+so there's time left for checking.  With --by-class, the class of each
+object must be loaded, so the objects are visited in random order.  If
+time runs out, the part of the database sampled from is reported:
+
+    >>> import itertools
+    >>> from unittest import mock
+    >>> clock = itertools.count()
+    >>> with mock.patch.object(zc.zodbdgc, 'time',
+    ...                        mock.Mock(time=lambda: next(clock))):
+    ...     zc.zodbdgc.sample_check('config', 10, True, 40, seed=0)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    db1 persistent.mapping.PersistentMapping: 9 sampled objects checked,
+        0 with errors, error rate at most 29.92%,
+        sampled from a random 9 of 22 objects
+    db2 persistent.mapping.PersistentMapping: 1 sampled objects checked,
+        0 with errors, error rate at most 79.35%
+    >>> print(handler)
+    zc.zodbdgc WARNING
+      db1: out of time, sampled from a random 9 of 22 objects
+    >>> handler.clear()
+
+Without a file-storage index, the current objects are found by reading
+all of the transactions, until time runs out, and only the class names
+are kept:
+
+    >>> import ZODB.MappingStorage
+    >>> storage = ZODB.MappingStorage.MappingStorage()
+    >>> db = ZODB.DB(storage)
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    ...     transaction.commit()
+    >>> clock = itertools.count()
+    >>> with mock.patch.object(zc.zodbdgc, 'time',
+    ...                        mock.Mock(time=lambda: next(clock))):
+    ...     sampled, coverage = zc.zodbdgc._sample(
+    ...         'db', storage, 10, True, random.Random(0), 5)
+    >>> [(key, len(oids)) for (key, oids) in sampled]
+    [(('db', 'persistent.mapping.PersistentMapping'), 6)]
+    >>> coverage
+    'objects written in the first 6 transactions'
+    >>> print(handler)
+    zc.zodbdgc WARNING
+      db: out of time, sampled from objects written in the first 6 transactions
+    >>> db.close()
+    >>> handler.uninstall()
+    """
+
+
+def test_throttle():
+    """
+Reading can be limited to a number of records and bytes per second,
+with up to a second's worth read in a burst:
+
+    >>> now = [0.0]
+    >>> def sleep(seconds):
+    ...     print('sleep', round(seconds, 3))
+    ...     now[0] += seconds
+    >>> clock = mock.patch('time.monotonic', lambda: now[0])
+    >>> sleeper = mock.patch('time.sleep', sleep)
+    >>> _ = clock.start(), sleeper.start()
+
+    >>> throttle = zc.zodbdgc.Throttle(10, 1000)
+    >>> for i in range(10):
+    ...     throttle.consume(1, 10)
+    >>> throttle.consume(1, 10)
+    sleep 0.1
+    >>> now[0] += 2
+    >>> throttle.consume(1, 1500)
+    sleep 0.5
+    >>> throttle.records, throttle.bytes, round(throttle.waited, 3)
+    (12, 1610, 0.6)
+
+The limits can be changed while running, with a limits file, which is
+checked at most once a second:
+
+    >>> with open('limits', 'w') as f:
+    ...     _ = f.write('records 1\\nbytes 0\\n')
+    >>> throttle = zc.zodbdgc.Throttle(10, 1000, 'limits')
+    >>> throttle.rates
+    [1.0, 0.0]
+    >>> throttle.consume(1, 10000)
+    >>> throttle.consume(1, 10000)
+    sleep 1.0
+    >>> with open('limits', 'w') as f:
+    ...     _ = f.write('records 0\\nbytes 100\\n')
+    >>> os.utime('limits', (0, 0))
+    >>> throttle.consume(1, 50)
+    sleep 0.5
+    >>> throttle.rates
+    [0.0, 100.0]
+
+The limits are used with the --max-records/-m, --max-bytes/-M and
+--limits-file/-L options, and the achieved throughput is logged:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> for i in range(4):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    ...     conn.transaction_manager.commit()
+    >>> del conn.root()[0]
+    >>> conn.transaction_manager.commit()
+    >>> db.pack()
+    >>> ptid = conn.root()._p_serial
+    >>> db.close()
+
+    >>> import zope.testing.loggingsupport
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zodbdgc')
+    >>> zc.zodbdgc.gc_command(['-m2', 'config'], ptid, return_bad=True)
+    ... # doctest: +ELLIPSIS
+    sleep ...
+    [('', 1)]
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+      : roots
+    zc.zodbdgc INFO
+      : recent
+    zc.zodbdgc INFO
+      : read 1 records, ... bytes in ... seconds, ... records/s, ...
+    zc.zodbdgc INFO
+      : read 5 records, ... bytes in ... seconds, ... records/s, ...
+    ...
+    >>> handler.clear()
+
+Object loads are limited when checking:
+
+    >>> zc.zodbdgc.check_command(['-m1', 'config']) # doctest: +ELLIPSIS
+    sleep ...
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc DEBUG
+      Checked 4 objects
+    zc.zodbdgc INFO
+      check: read 4 records, ... bytes in ... seconds, ... records/s, ...
+
+    >>> handler.uninstall()
+    >>> _ = clock.stop(), sleeper.stop()
+    """
+
+
+def test_bulk_filestorage():
+    """
+With the --bulk-delete/-D option, delete records are written to file
+storages in large transactions, rather than in many small ones:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, ZODB.FileStorage, ZODB.utils
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> for i in range(250):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping()
+    >>> conn.transaction_manager.commit()
+    >>> for i in range(220):
+    ...     del conn.root()[i]
+    >>> conn.transaction_manager.commit()
+    >>> db.pack()
+    >>> ptid = conn.root()._p_serial
+    >>> ntrans = len(db.storage.undoLog(0, 1000))
+    >>> db.close()
+
+    >>> bad = zc.zodbdgc.gc_command(['-D', 'config'], ptid, return_bad=True)
+    >>> len(bad)
+    220
+    >>> bad = [(name, ZODB.utils.p64(oid)) for (name, oid) in bad]
+
+    >>> fs = ZODB.FileStorage.FileStorage('1.fs', read_only=True)
+    >>> len(fs.undoLog(0, 1000)) - ntrans
+    1
+    >>> def exists(oid):
+    ...     try:
+    ...         return bool(fs.load(oid))
+    ...     except ZODB.POSException.POSKeyError:
+    ...         return False
+    >>> sum(exists(oid) for (_, oid) in bad)
+    0
+    >>> fs.close()
+
+The file is valid:
+
+    >>> import ZODB.scripts.fstest
+    >>> ZODB.scripts.fstest.check('1.fs')
+
+Objects written since the analysis aren't deleted.  Garbage is
+deleted in batches:
+
+    >>> db = ZODB.DB('1.fs')
+    >>> conn = db.open()
+    >>> obs = [conn.root()[i] for i in range(230, 250)]
+    >>> _ = [ob._p_activate() for ob in obs]
+    >>> garbage = [(ob._p_oid, ob._p_serial) for ob in obs]
+    >>> ob = obs[-1]
+    >>> ob['x'] = 1
+    >>> conn.transaction_manager.commit()
+    >>> zc.zodbdgc._delete_filestorage_garbage(db.storage, garbage, 7)
+    19
+    >>> len(db.storage.undoLog(0, 1000)) - ntrans
+    5
+    >>> db.close()
+    >>> ZODB.scripts.fstest.check('1.fs')
+    """
+
+
+def test_only():
+    """
+Garbage can be collected in one database only, with the --only/-o
+option.  The references from other databases are found using
+summaries saved, in the directory given with the --summaries/-s
+option, by an earlier collection:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db1>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 2.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, transaction, ZODB.utils
+    >>> def opendb():
+    ...     with open('config') as f:
+    ...         db = ZODB.config.databaseFromFile(f)
+    ...     conn = db.open()
+    ...     return conn, conn.get_connection('db2')
+    >>> def close(conn):
+    ...     ptid = conn.root()._p_serial
+    ...     for d in conn.db().databases.values():
+    ...         d.pack()
+    ...         d.close()
+    ...     return ptid
+    >>> def new(conn):
+    ...     ob = persistent.mapping.PersistentMapping()
+    ...     conn.add(ob)
+    ...     return ob
+    >>> def oid(ob):
+    ...     return ZODB.utils.u64(ob._p_oid)
+
+    >>> conn, conn2 = opendb()
+    >>> for name in 'abcd':
+    ...     conn.root()[name] = new(conn)
+    ...     conn2.root()[name] = new(conn2)
+    >>> conn.root()['a']['x'] = conn2.root()['a']
+    >>> conn2.root()['b']['x'] = conn.root()['b']
+    >>> transaction.commit()
+    >>> for name in 'abc':
+    ...     del conn.root()[name]
+    ...     del conn2.root()[name]
+    >>> transaction.commit()
+    >>> os.mkdir('summaries')
+    >>> ptid = close(conn)
+
+    >>> zc.zodbdgc.gc_command(['-s', 'summaries', 'config'], ptid,
+    ...                       return_bad=True)
+    [('db1', 1), ('db1', 2), ('db1', 3), ('db2', 1), ('db2', 2), ('db2', 3)]
+    >>> sorted(os.listdir('summaries'))
+    ['db1.xrefs', 'db2.xrefs']
+
+Objects in db2, including new objects, that reference objects in db1
+keep them from being collected, and other databases aren't changed:
+
+    >>> conn, conn2 = opendb()
+    >>> garbage = conn.root()['e'] = new(conn)
+    >>> kept = new(conn)
+    >>> garbage2 = conn2.root()['e'] = new(conn2)
+    >>> conn2.root()['d']['x'] = kept
+    >>> transaction.commit()
+    >>> del conn.root()['e']
+    >>> del conn2.root()['e']
+    >>> transaction.commit()
+    >>> expected = oid(garbage), oid(garbage2), oid(kept)
+    >>> ptid = close(conn)
+    >>> expected
+    (5, 5, 6)
+
+    >>> zc.zodbdgc.gc_command(['-s', 'summaries', '-o', 'db1', 'config'],
+    ...                       ptid, return_bad=True)
+    [('db1', 5)]
+
+    >>> conn, conn2 = opendb()
+    >>> conn2.root()['d']['x'] is conn.get(kept._p_oid)
+    True
+    >>> len(conn2.get(garbage2._p_oid))
+    0
+    >>> ptid = close(conn)
+
+A full collection is needed first:
+
+    >>> os.remove('summaries/db2.xrefs')
+    >>> zc.zodbdgc.gc_command(['-s', 'summaries', '-o', 'db1', 'config'],
+    ...                       ptid) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: No summary for 'db2', a full collection saving summaries ...
+    """
+
+
+def test_only_summary_from_file():
+    """
+Summaries saved by a collection reading files with -f only cover the
+transactions in the files, even if the files are behind the storages:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb db1>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 2.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, shutil, transaction, ZODB.utils
+    >>> def opendb():
+    ...     with open('config') as f:
+    ...         db = ZODB.config.databaseFromFile(f)
+    ...     conn = db.open()
+    ...     return conn, conn.get_connection('db2')
+    >>> def close(conn):
+    ...     transaction.commit()
+    ...     databases = conn.db().databases.values()
+    ...     for d in databases:
+    ...         d.pack()
+    ...     last = max(d.lastTransaction() for d in databases)
+    ...     for d in databases:
+    ...         d.close()
+    ...     return ZODB.utils.p64(ZODB.utils.u64(last) + 1)
+
+    >>> conn, conn2 = opendb()
+    >>> x = conn.root()['x'] = persistent.mapping.PersistentMapping()
+    >>> h = conn2.root()['h'] = persistent.mapping.PersistentMapping()
+    >>> transaction.commit()
+    >>> _ = shutil.copyfile('2.fs', 'c2.fs')
+    >>> h['x'] = x
+    >>> ptid = close(conn)
+
+The copy of db2 doesn't have its reference to x, which is still
+referenced in db1:
+
+    >>> os.mkdir('summaries')
+    >>> zc.zodbdgc.gc_command(['-s', 'summaries', '-f', 'db2=c2.fs',
+    ...                        'config'], ptid, return_bad=True)
+    []
+
+Now x is only referenced from db2.  Collecting db1 only reads the
+transaction with the reference from db2, so x is kept:
+
+    >>> conn, conn2 = opendb()
+    >>> del conn.root()['x']
+    >>> ptid = close(conn)
+    >>> zc.zodbdgc.gc_command(['-s', 'summaries', '-o', 'db1', 'config'],
+    ...                       ptid, return_bad=True)
+    []
+    >>> conn, conn2 = opendb()
+    >>> conn2.root()['h']['x']
+    {}
+    >>> _ = close(conn)
+    """
+
+
+def test_revalidate():
+    """
+Before garbage is removed, the transactions committed since the
+analysis are read, and garbage written or referenced in them is kept.
+This matters most when analyzing a lagging secondary:
+
+    >>> for name, path in (('config', '1.fs'), ('config2', '2.fs')):
+    ...     with open(name, 'w') as f:
+    ...         _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path %s
+    ...     </filestorage>
+    ... </zodb>
+    ... ''' % path)
+    >>> import persistent.mapping, shutil, ZODB.utils
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> obs = {}
+    >>> for name in 'abcd':
+    ...     ob = obs[name] = persistent.mapping.PersistentMapping()
+    ...     conn.root()[name] = ob
+    >>> obs['a']['c'] = obs['c']
+    >>> conn.transaction_manager.commit()
+    >>> for name in 'abcd':
+    ...     del conn.root()[name]
+    >>> conn.transaction_manager.commit()
+    >>> db.pack()
+    >>> ptid = conn.root()._p_serial
+    >>> _ = shutil.copyfile('1.fs', '2.fs')
+
+After the secondary was copied, a garbage object is referenced again,
+along with the object it references, and another is written:
+
+    >>> conn.root()['a'] = obs['a']
+    >>> obs['b']['x'] = 1
+    >>> conn.transaction_manager.commit()
+    >>> db.close()
+    >>> sorted((ZODB.utils.u64(ob._p_oid), name)
+    ...        for (name, ob) in obs.items())
+    [(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')]
+
+    >>> import zope.testing.loggingsupport
+    >>> handler = zope.testing.loggingsupport.InstalledHandler('zc.zodbdgc')
+    >>> zc.zodbdgc.gc_command(['config', 'config2'], ptid, return_bad=True)
+    [('', 4)]
+    >>> print(handler) # doctest: +ELLIPSIS
+    zc.zodbdgc INFO
+    ...
+    zc.zodbdgc INFO
+      : kept 1 garbage objects written and 2 referenced since ...
+    ...
+    >>> handler.uninstall()
+
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> conn.root()['a']['c'], conn.get(obs['b']._p_oid)
+    ({}, {'x': 1})
+    >>> db.close()
+    """
+
+
+def test_revalidate_file():
+    """
+When files given with -f are analyzed, the transactions committed
+after the last one in the files are revalidated, even if the files are
+behind the storages:
+
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> import persistent.mapping, shutil
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> conn = db.open()
+    >>> a = conn.root()['a'] = persistent.mapping.PersistentMapping()
+    >>> h = conn.root()['h'] = persistent.mapping.PersistentMapping()
+    >>> conn.transaction_manager.commit()
+    >>> del conn.root()['a']
+    >>> conn.transaction_manager.commit()
+    >>> db.pack()
+    >>> ptid = db.lastTransaction()
+    >>> _ = shutil.copyfile('1.fs', '2.fs')
+
+After the file was copied, the garbage is referenced from an object
+other than the root:
+
+    >>> h['a'] = a
+    >>> conn.transaction_manager.commit()
+    >>> db.close()
+
+    >>> zc.zodbdgc.gc_command(['-d0', '-f=2.fs', 'config'], ptid,
+    ...                       return_bad=True)
+    []
+
+    >>> with open('config') as f:
+    ...     db = ZODB.config.databaseFromFile(f)
+    >>> db.open().root()['h']['a']
+    {}
+    >>> db.close()
+    """
+
+
+def test_mapped():
+    """
+With the --mmap/-F option, files given with -f are read by
+memory-mapping them.  Records are provided as (oid, tid, data) tuples,
+with the data as memoryviews of the file, following backpointers, and
+transactions as lists of records:
+
+    >>> import persistent.mapping, ZODB.FileStorage
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage('1.fs', pack_gc=False))
+    >>> conn = db.open()
+    >>> for i in range(6):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping(x=i)
+    ...     conn.transaction_manager.commit()
+    >>> conn.root()[1]['x'] = 'changed'
+    >>> conn.transaction_manager.commit()
+    >>> undo = db.undoLog(0, 1)[0]['id']
+    >>> db.undo(undo)
+    >>> conn.transaction_manager.commit()
+    >>> for i in range(3):
+    ...     del conn.root()[i]
+    ...     conn.transaction_manager.commit()
+    >>> tids = [t.tid for t in db.storage.iterator()]
+    >>> ptid = tids[-1]
+    >>> db.close()
+
+    >>> def records(it):
+    ...     try:
+    ...         return [(r.oid, r.tid, r.data and bytes(r.data))
+    ...                 for trans in it for r in trans]
+    ...     finally:
+    ...         it.close()
+    >>> it = zc.zodbdgc.MappedIterator('1.fs')
+    >>> trans = next(iter(it))
+    >>> trans[0].oid, type(trans[0].data)
+    (b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00', <class 'memoryview'>)
+    >>> del trans
+    >>> it.close()
+
+The records are the same as those provided by file iterators, with or
+without start and stop transaction ids:
+
+    >>> for start, stop in ((None, None), (tids[3], None), (None, tids[8]),
+    ...                     (tids[3], tids[8])):
+    ...     mapped = records(zc.zodbdgc.MappedIterator('1.fs', start, stop))
+    ...     expected = records(ZODB.FileStorage.FileIterator(
+    ...         '1.fs', start, stop))
+    ...     print(len(mapped), mapped == expected)
+    18 True
+    13 True
+    15 True
+    10 True
+
+The first transaction at or after start is found by searching backward
+from the end of the file when start is nearer to it:
+
+    >>> from ZODB.utils import p64, u64
+    >>> starts = sorted(set(tids + [p64(u64(tid) + 1) for tid in tids]
+    ...                     + [p64(u64(tids[0]) - 1)]))
+    >>> all(records(zc.zodbdgc.MappedIterator('1.fs', start))
+    ...     == records(ZODB.FileStorage.FileIterator('1.fs', start))
+    ...     for start in starts)
+    True
+    >>> def start_pos(start):
+    ...     it = ZODB.FileStorage.FileIterator('1.fs', start)
+    ...     it.close()
+    ...     return it._pos
+    >>> it = zc.zodbdgc.MappedIterator('1.fs')
+    >>> [it._start_pos(it._map, start) == start_pos(start)
+    ...  for start in (tids[0], tids[-2], tids[-1], starts[-1])]
+    [True, True, True, True]
+    >>> it.close()
+
+The option is used for garbage collection:
+
+    >>> db = ZODB.DB(ZODB.FileStorage.FileStorage('1.fs', pack_gc=False))
+    >>> db.pack()
+    >>> db.close()
+    >>> import shutil
+    >>> _ = shutil.copyfile('1.fs', '2.fs')
+    >>> with open('config', 'w') as f:
+    ...     _ = f.write('''
+    ... <zodb>
+    ...     <filestorage>
+    ...         pack-gc false
+    ...         path 1.fs
+    ...     </filestorage>
+    ... </zodb>
+    ... ''')
+    >>> zc.zodbdgc.gc_command(['-F', '-f=2.fs', 'config'], ptid,
+    ...                       return_bad=True)
+    [('', 1), ('', 2), ('', 3)]
+    """
+
+
+def test_relstorage_bulk():
+    """
+With the --bulk/-b option, RelStorage databases are read with bulk
+queries and garbage is removed from history-free RelStorages with
+batched deletes.  The results are the same as without the option:
+
+    >>> def make(name, keep_history):
+    ...     os.mkdir(name)
+    ...     os.mkdir(name + '2')
+    ...     with open(name + '.conf', 'w') as f:
+    ...         _ = f.write('''
+    ... %%import relstorage
+    ... <zodb db1>
+    ...     <relstorage>
+    ...         keep-history %(h)s
+    ...         pack-gc false
+    ...         <sqlite3>
+    ...             data-dir %(name)s
+    ...         </sqlite3>
+    ...     </relstorage>
+    ... </zodb>
+    ... <zodb db2>
+    ...     <relstorage>
+    ...         keep-history %(h)s
+    ...         pack-gc false
+    ...         <sqlite3>
+    ...             data-dir %(name)s2
+    ...         </sqlite3>
+    ...     </relstorage>
+    ... </zodb>
+    ... ''' % dict(h=keep_history, name=name))
+    ...     with open(name + '.conf') as f:
+    ...         db = ZODB.config.databaseFromFile(f)
+    ...     conn = db.open()
+    ...     conn2 = conn.get_connection('db2')
+    ...     for i in range(6):
+    ...         conn2.root()[i] = persistent.mapping.PersistentMapping()
+    ...         conn.transaction_manager.commit()
+    ...         conn.root()[i] = persistent.mapping.PersistentMapping(
+    ...             x=conn2.root()[i])
+    ...         conn.transaction_manager.commit()
+    ...     for i in range(0, 6, 2):
+    ...         del conn.root()[i], conn2.root()[i]
+    ...     conn.transaction_manager.commit()
+    ...     _ = [d.pack() for d in db.databases.values()]
+    ...     conn.root()[1].x = conn2.root()[1]
+    ...     conn.transaction_manager.commit()
+    ...     ptid = ZODB.utils.p64(ZODB.utils.u64(db.lastTransaction()) + 1)
+    ...     _ = [d.close() for d in db.databases.values()]
+    ...     return ptid
+
+    >>> import persistent.mapping, ZODB.utils
+    >>> for keep_history in ('false', 'true'):
+    ...     ptid = make('generic' + keep_history, keep_history)
+    ...     generic = zc.zodbdgc.gc_command(
+    ...         ['generic%s.conf' % keep_history], ptid, return_bad=True)
+    ...     ptid = make('bulk' + keep_history, keep_history)
+    ...     bulk = zc.zodbdgc.gc_command(
+    ...         ['-b', 'bulk%s.conf' % keep_history], ptid, return_bad=True)
+    ...     print(keep_history, bulk == generic)
+    ...     print(bulk)
+    false True
+    [('db1', 1), ('db1', 3), ('db1', 5), ('db2', 1), ('db2', 3), ('db2', 5)]
+    true True
+    [('db1', 1), ('db1', 3), ('db1', 5), ('db2', 1), ('db2', 3), ('db2', 5)]
+
+The garbage is gone, and the databases are still valid:
+
+    >>> for name in ('genericfalse', 'bulkfalse', 'generictrue', 'bulktrue'):
+    ...     print(name, zc.zodbdgc.gc_command(
+    ...         ['-b', name + '.conf'], ptid, return_bad=True))
+    ...     zc.zodbdgc.check(name + '.conf')
+    genericfalse []
+    bulkfalse []
+    generictrue []
+    bulktrue []
+    """
+
+
+if relstorage is None:
+    del test_relstorage_bulk
+
+
 def test_suite():
     suite = unittest.TestSuite((
         doctest.DocFileSuite(